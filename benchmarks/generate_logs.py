@@ -0,0 +1,223 @@
+"""
+Generate synthetic log files in the format of `data/2019-*.log`.
+
+Accounts sign up at random times in the period, then log in every few days
+(each login is followed by a page access, and an upload from the upload page)
+until they churn, after which they never log in again. Events are written in
+date order to one file per (local) month, with memory bounded by the number
+of accounts, so the output can grow to hundreds of millions of events.
+
+This can be run from the root folder via:
+    `venv/bin/python -m benchmarks.generate_logs --accounts 100000 --out /tmp/logs`
+"""
+
+import argparse
+import calendar
+import heapq
+import os
+import random
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+PLANS = {"PLAN_BRONZE": 0.6, "PLAN_SILVER": 0.2, "PLAN_GOLD": 0.2}
+PAGES = ["add_account_page", "edit_entry_page", "upload_page"]
+FIRSTNAMES = ["Audrey", "Beatrice", "Carlos", "Dana", "Elliot", "Farah", "Gus"]
+LASTNAMES = ["Lucero", "Lyons", "Tremblay", "Singh", "Nguyen", "MacLeod", "Roy"]
+STREETS = ["W. Dogwood Drive", "Sugar Lane", "Augusta St.", "Lakeshore St."]
+# Province: (share of accounts, cities, first letters of its postal codes)
+PROVINCES = {
+    "AB": (0.084, ["Calgary", "Stony Plain"], "T"),
+    "BC": (0.081, ["Vancouver", "Kelowna"], "V"),
+    "MB": (0.030, ["Winnipeg"], "R"),
+    "NB": (0.168, ["Moncton", "Fredericton"], "E"),
+    "NF": (0.032, ["St. John's"], "A"),
+    "NS": (0.068, ["Halifax"], "B"),
+    "NT": (0.002, ["Yellowknife"], "X"),
+    "NU": (0.004, ["Iqaluit"], "X"),
+    "ON": (0.224, ["Toronto", "Ottawa", "Kingston"], "KLMNP"),
+    "PE": (0.008, ["Charlottetown"], "C"),
+    "QC": (0.283, ["Montreal", "Chibougamau"], "GHJ"),
+    "SK": (0.014, ["Regina"], "S"),
+    "YT": (0.002, ["Whitehorse"], "Y"),
+}
+
+MONTH_NAMES = [name.lower() for name in calendar.month_name]
+
+# Event kinds, in the order they sort when they happen at the same second
+SIGN_UP, LOGIN, PAGE_ACCESS, UPLOAD, PLAN_CHANGE = range(5)
+
+
+@lru_cache(maxsize=None)
+def daylight_time(year):
+    """Toronto's daylight time in UTC: from the 2nd Sunday of March to the 1st
+    Sunday of November, both at 2am local time"""
+    march = datetime(year, 3, 8)
+    november = datetime(year, 11, 1)
+    return (
+        march + timedelta(days=6 - march.weekday(), hours=2 + 5),
+        november + timedelta(days=6 - november.weekday(), hours=2 + 4),
+    )
+
+
+def toronto_offset(utc):
+    """Hours from UTC in Toronto"""
+    start, end = daylight_time(utc.year)
+    return -4 if start <= utc < end else -5
+
+
+def local_date(utc):
+    offset = toronto_offset(utc)
+    local = utc + timedelta(hours=offset)
+    return local, f"{local.isoformat()}-0{-offset}:00"
+
+
+def postal_code(rng, letters):
+    digit = rng.randint(0, 9)
+    return (
+        f"{rng.choice(letters)}{digit}{rng.choice('ABCEGHJKLMNPRSTVWXYZ')} "
+        f"{rng.randint(0, 9)}{rng.choice('ABCEGHJKLMNPRSTVWXYZ')}{rng.randint(0, 9)}"
+    )
+
+
+def address(rng):
+    province = rng.choices(list(PROVINCES), [p[0] for p in PROVINCES.values()])[0]
+    _, cities, letters = PROVINCES[province]
+    street = f"{rng.randint(1, 9999)} {rng.choice(STREETS)}"
+    return f"'{street}, {rng.choice(cities)}, {province} {postal_code(rng, letters)}'"
+
+
+class Generator:
+    """Yields (local datetime, log line) in date order"""
+
+    def __init__(self, accounts, start, end, login_days, churn, plan_change, seed):
+        self.rng = random.Random(seed)
+        self.start = start
+        self.end = end
+        self.login_days = login_days
+        self.churn = churn
+        self.plan_change = plan_change
+        self.queue = []
+        self.plans = {}
+
+        span = (end - start).total_seconds()
+        for account in range(10000, 10000 + accounts):
+            signup = start + timedelta(seconds=int(self.rng.random() * span))
+            self.push(signup, SIGN_UP, account)
+
+    def push(self, when, kind, account, detail=None):
+        if when < self.end:
+            heapq.heappush(self.queue, (when, kind, account, detail))
+
+    def line(self, when, log_type, account, rest):
+        local, date = local_date(when)
+        return (
+            local,
+            f'{{"date": "{date}", "log_type": "{log_type}", "level": "INFO", '
+            f'"account": {account}, {rest}}}\n',
+        )
+
+    def after(self, days):
+        return timedelta(seconds=int(self.rng.expovariate(1 / days) * 86400) + 60)
+
+    def __iter__(self):
+        rng = self.rng
+        while self.queue:
+            when, kind, account, detail = heapq.heappop(self.queue)
+            if kind == SIGN_UP:
+                plan = rng.choices(list(PLANS), list(PLANS.values()))[0]
+                self.plans[account] = plan
+                rest = (
+                    f'"plan": "{plan}", "firstname": "{rng.choice(FIRSTNAMES)}", '
+                    f'"lastname": "{rng.choice(LASTNAMES)}", '
+                    f'"address": "{address(rng)}"'
+                )
+                yield self.line(when, "SIGN_UP", account, rest)
+                self.push(when + self.after(self.login_days), LOGIN, account)
+                if rng.random() < self.plan_change:
+                    self.push(when + self.after(45), PLAN_CHANGE, account)
+
+            elif kind == LOGIN:
+                yield self.line(when, "LOGIN", account, '"details": "web login"')
+                page = rng.choice(PAGES)
+                self.push(when + timedelta(seconds=60), PAGE_ACCESS, account, page)
+                if rng.random() >= self.churn:
+                    self.push(when + self.after(self.login_days), LOGIN, account)
+
+            elif kind == PAGE_ACCESS:
+                rest = f'"details": "{detail}"'
+                yield self.line(when, "PAGE_ACCESS", account, rest)
+                if detail == "upload_page":
+                    self.push(when + timedelta(seconds=30), UPLOAD, account)
+
+            elif kind == UPLOAD:
+                rest = '"details": "myfile.pdf"'
+                yield self.line(when, "UPLOAD", account, rest)
+
+            elif kind == PLAN_CHANGE:
+                plan = self.plans[account]
+                to = rng.choice([p for p in PLANS if p != plan])
+                self.plans[account] = to
+                _, date = local_date(when)
+                rest = (
+                    f'"details": {{"change_date": "{date}", '
+                    f'"from": "{plan}", "to": "{to}"}}'
+                )
+                yield self.line(when, "PLAN_CHANGE", account, rest)
+
+
+def write_logs(events, folder):
+    """Write each event to the `<year>-<month>.log` file of its local date"""
+    os.makedirs(folder, exist_ok=True)
+    f, current, count = None, None, 0
+    for local, line in events:
+        if (local.year, local.month) != current:
+            if f:
+                f.close()
+            current = (local.year, local.month)
+            name = f"{local.year}-{MONTH_NAMES[local.month]}.log"
+            f = open(os.path.join(folder, name), "a")
+        f.write(line)
+        count += 1
+    if f:
+        f.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", default="generated_data")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--start", default="2019-01-01")
+    parser.add_argument("--end", default="2020-01-01")
+    parser.add_argument(
+        "--login-days", type=float, default=4, help="Mean days between logins"
+    )
+    parser.add_argument(
+        "--churn", type=float, default=0.02, help="Chance of leaving after a login"
+    )
+    parser.add_argument(
+        "--plan-change", type=float, default=0.12, help="Share changing plan"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.out) and os.listdir(args.out):
+        parser.error(f"{args.out} is not empty, files are appended to")
+
+    # The period is in local time, the generator works in UTC
+    start, end = (datetime.fromisoformat(d) for d in (args.start, args.end))
+    generator = Generator(
+        args.accounts,
+        start - timedelta(hours=toronto_offset(start)),
+        end - timedelta(hours=toronto_offset(end)),
+        args.login_days,
+        args.churn,
+        args.plan_change,
+        args.seed,
+    )
+    count = write_logs(generator, args.out)
+    print(f"Wrote {count} events for {args.accounts} accounts to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
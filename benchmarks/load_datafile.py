@@ -0,0 +1,95 @@
+"""
+Benchmark the COPY based `load_datafile` against the original INSERT loader.
+
+Each loader loads the `data/2019-*.log` files into its own scratch table and
+reports wall time, rows/s and the peak python memory used while loading. The
+COPY loader also types the rows into monthly partitions, the INSERT loader
+only stores the raw JSON.
+
+This can be run from the root folder via:
+    `venv/bin/python -m benchmarks.load_datafile`
+"""
+
+import glob
+import time
+import tracemalloc
+
+from sqlalchemy import text
+
+from libraries.database import create_events_table, load_datafile, session_scope
+
+
+def insert_datafile(datafile, table_name):
+    """The original loader: one multi-row INSERT statement per file"""
+    with open(datafile) as f:
+        values = [row for row in f.readlines()]
+        values = [row.replace("'", "''") for row in values]  # escape single-quotes
+        values_str = "'),('".join(values)
+        insert_sql = f"INSERT INTO {table_name} (raw) VALUES ('{values_str}');"
+
+    with session_scope() as db:
+        db.execute(text(insert_sql))
+    return len(values)
+
+
+def copy_datafile(datafile, table_name):
+    return load_datafile(datafile, table_name=table_name)
+
+
+def create_insert_table(table_name):
+    return text(f"CREATE TABLE {table_name} (raw JSONB);")
+
+
+def drop_table(table_name):
+    """Drop `table_name` and what the loader recorded about it."""
+    with session_scope() as db:
+        db.execute(text(f"DROP TABLE IF EXISTS {table_name};"))
+        for bookkeeping in ("ingest_manifest", "ingest_loads", "ingest_rejects"):
+            db.execute(
+                text(f"DELETE FROM {bookkeeping} WHERE table_name = :table_name"),
+                {"table_name": table_name},
+            )
+
+
+def run(loader, create_table, datafiles, table_name):
+    drop_table(table_name)
+    with session_scope() as db:
+        db.execute(create_table(table_name))
+
+    rows = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for datafile in datafiles:
+        rows += loader(datafile, table_name)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    drop_table(table_name)
+
+    return rows, elapsed, peak
+
+
+def main(pattern="data/2019-*.log"):
+    datafiles = sorted(glob.glob(pattern))
+    with session_scope() as db:
+        db.execute(create_events_table("_bench_events"))  # also creates the manifest
+
+    results = {
+        "insert": run(
+            insert_datafile, create_insert_table, datafiles, "_bench_insert_logs"
+        ),
+        "copy": run(copy_datafile, create_events_table, datafiles, "_bench_events"),
+    }
+
+    print(f"\n{len(datafiles)} files")
+    print(f"{'loader':<8}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak MiB':>10}")
+    for loader, (rows, elapsed, peak) in results.items():
+        print(
+            f"{loader:<8}{rows:>10}{elapsed:>10.2f}"
+            f"{rows / elapsed:>12.0f}{peak / 2 ** 20:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Time each stage of the pipeline and keep the results to compare between commits.
+
+The stages are loading each log file (`load_datafile`), building each table of
+the DAG (`fan_out_tables` / `create_table`, as a full refresh) and running each
+dashboard query without the query cache. Results are written to
+`benchmarks/results/<commit>.json`.
+
+This rebuilds every table from the given logs, so point POSTGRES_* at a scratch
+database. It can be run from the root folder via:
+    `venv/bin/python -m benchmarks.pipeline --data /tmp/logs --compare <commit>`
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from libraries.database import (
+    build_order,
+    create_events_table,
+    create_table,
+    fan_out_tables,
+    list_datafiles,
+    load_datafile,
+    read_table_metadata,
+    session_scope,
+    table_dependencies,
+)
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(__file__), "results")
+
+
+def dag_tables():
+    """The bronze (fan out) tables and the other tables, as etl/dags builds them"""
+    tables = build_order(table_dependencies())
+    bronze = [t for t in tables if "log_type" in read_table_metadata(t)]
+    return bronze, [t for t in tables if t not in bronze]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def count_rows(table_name):
+    with session_scope() as db:
+        return db.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
+
+
+def timed(stage, target, run, rows=None):
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    rows = rows() if rows else result
+    return {"stage": stage, "target": target, "seconds": seconds, "rows": rows}
+
+
+def bench_load(datafiles):
+    with session_scope() as db:
+        db.execute(create_events_table("events"))
+        db.execute(text("TRUNCATE events;"))
+        db.execute(text("DELETE FROM ingest_manifest WHERE table_name = 'events';"))
+
+    return [
+        timed("load", os.path.basename(datafile), lambda: load_datafile(datafile))
+        for datafile in datafiles
+    ]
+
+
+def bench_tables():
+    bronze_tables, tables = dag_tables()
+    results = [
+        timed(
+            "table",
+            "bronze_fan_out",
+            lambda: fan_out_tables(bronze_tables, full_refresh=True),
+            rows=lambda: sum(count_rows(t) for t in bronze_tables),
+        )
+    ]
+    for table_name in tables:
+        results.append(
+            timed(
+                "table",
+                table_name,
+                lambda: create_table(table_name, full_refresh=True),
+                rows=lambda: count_rows(table_name),
+            )
+        )
+    return results
+
+
+def bench_queries(repeat):
+    # Imported here so the load and table stages run without dash installed
+    from xero_dash import dashboard
+
+    results = []
+    queries = {k: v for k, v in vars(dashboard).items() if k.endswith("_QUERY")}
+    for name, query in sorted(queries.items()):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with session_scope() as db:
+                rows = len(db.execute(query.clause, query.params).fetchall())
+            timings.append(time.perf_counter() - start)
+        result = {
+            "stage": "query",
+            "target": name,
+            "seconds": statistics.median(timings),
+            "rows": rows,
+        }
+        results.append(result)
+    return results
+
+
+def report(results, previous=None):
+    """Print each stage's time, and its change against a previous run if given"""
+    before = {}
+    if previous:
+        before = {(r["stage"], r["target"]): r["seconds"] for r in previous["stages"]}
+        print(f"\nCompared to {previous['commit']} ({previous['date']})")
+
+    print(f"\n{'stage':<10}{'target':<30}{'rows':>12}{'seconds':>10}{'before':>10}")
+    for result in results["stages"]:
+        key = (result["stage"], result["target"])
+        line = f"{key[0]:<10}{key[1]:<30}{result['rows']:>12}{result['seconds']:>10.3f}"
+        if key in before:
+            change = (result["seconds"] - before[key]) / max(before[key], 1e-9)
+            line += f"{before[key]:>10.3f}{change:>+8.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data", default=None, help="Defaults to DATA_FOLDER")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each query")
+    parser.add_argument("--skip-queries", action="store_true")
+    parser.add_argument("--compare", help="Commit of a previous run to compare to")
+    args = parser.parse_args()
+
+    datafiles = list_datafiles(args.data)
+    stages = bench_load(datafiles) + bench_tables()
+    if not args.skip_queries:
+        stages += bench_queries(args.repeat)
+
+    results = {
+        "commit": current_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "data": {
+            "files": len(datafiles),
+            "bytes": sum(os.path.getsize(f) for f in datafiles),
+        },
+        "stages": stages,
+    }
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    path = os.path.join(RESULTS_FOLDER, f"{results['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(os.path.join(RESULTS_FOLDER, f"{args.compare}.json")) as f:
+            previous = json.load(f)
+    report(results, previous)
+    print(f"\nSaved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,108 @@
+import os
+
+from datetime import datetime
+
 from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
 from airflow.utils.dates import days_ago
 
-from libraries.database import create_table, extract_log_data
-
-
-dag = DAG(
-    "log_data_processing",
-    start_date=days_ago(1),
-    description="A simple DAG to process Xero event log data",
-    schedule_interval="@once",
+from libraries.database import (
+    build_order,
+    create_table,
+    extract_log_data,
+    fan_out_tables,
+    read_table_metadata,
+    table_dependencies,
 )
+from libraries.snapshots import export_snapshot, snapshot_tables
 
+# Months a backfill processes at once; each run loads up to LOAD_WORKERS files
+BACKFILL_MAX_ACTIVE_RUNS = int(os.getenv("BACKFILL_MAX_ACTIVE_RUNS", "4"))
 
-t_log = PythonOperator(
-    task_id="extract_log_data", python_callable=extract_log_data, dag=dag
-)
+# Each backfill run only processes the month (UTC) of its execution date
+BACKFILL_WINDOW = {"window_start": "{{ ds }}", "window_end": "{{ next_ds }}"}
 
 
-def etl_table(table_name, table_type, dag):
+def etl_table(table_name, table_type, dag, window):
     return PythonOperator(
         task_id=f"{table_type}_table_{table_name}",
         python_callable=create_table,
-        op_kwargs={"table_name": table_name},
+        op_kwargs={"table_name": table_name, **window},
+        dag=dag,
+    )
+
+
+def build_dag(dag, window=None):
+    """Add the ETL's tasks to `dag`, each limited to `window` (the templated
+    `window_start` and `window_end` arguments) if given."""
+    window = window or {}
+    t_log = PythonOperator(
+        task_id="extract_log_data",
+        python_callable=extract_log_data,
+        op_kwargs=window,
         dag=dag,
     )
 
+    # Every etl/sql/*.sql file is a task, wired to the tables its query reads
+    # from, so adding a SQL file is enough to schedule it
+    dependencies = table_dependencies()
+    metadata = {t: read_table_metadata(t) for t in dependencies}
+
+    # All bronze tables are routed from a single read of the events table
+    bronze_tables = [t for t in build_order(dependencies) if "log_type" in metadata[t]]
+    t_bronze = PythonOperator(
+        task_id="bronze_fan_out",
+        python_callable=fan_out_tables,
+        op_kwargs={"table_names": bronze_tables, **window},
+        dag=dag,
+    )
 
-t_signup = etl_table("signup", "bronze", dag)
-t_signup << t_log
+    tasks = {"events": t_log}
+    tasks.update({table_name: t_bronze for table_name in bronze_tables})
+    for table_name in build_order(dependencies):
+        if table_name not in tasks:
+            table_type = metadata[table_name].get("table_type", "table")
+            tasks[table_name] = etl_table(table_name, table_type, dag, window)
 
-t_login = etl_table("login", "bronze", dag)
-t_login << t_log
+    edges = {
+        (tasks[upstream].task_id, tasks[table_name].task_id)
+        for table_name, upstream_tables in dependencies.items()
+        for upstream in upstream_tables
+    }
+    for upstream_task_id, task_id in edges:
+        if upstream_task_id != task_id:
+            dag.set_dependency(upstream_task_id, task_id)
 
-t_plan_change = etl_table("plan_change", "bronze", dag)
-t_plan_change << t_log
+    # The dashboard's snapshot read mode serves the tables exported once
+    # they're built
+    t_snapshot = PythonOperator(
+        task_id="export_snapshot", python_callable=export_snapshot, dag=dag
+    )
+    for table_name in snapshot_tables():
+        dag.set_dependency(tasks[table_name].task_id, t_snapshot.task_id)
+    return dag
 
-t_churn_event = etl_table("churn_event", "silver", dag)
-t_churn_event << t_login
 
-t_user_location = etl_table("user_location", "silver", dag)
-t_user_location << t_signup
+dag = build_dag(
+    DAG(
+        "log_data_processing",
+        start_date=days_ago(1),
+        description="A simple DAG to process Xero event log data",
+        schedule_interval="@once",
+    )
+)
 
-t_province_by_year = etl_table("province_by_year", "gold", dag)
-t_province_by_year << t_user_location
+# Reprocesses the data month by month, eg. March 2019 only via
+#   `airflow backfill log_data_backfill -s 2019-03-01 -e 2019-03-01`
+# Longer ranges run BACKFILL_MAX_ACTIVE_RUNS months at a time
+backfill_dag = build_dag(
+    DAG(
+        "log_data_backfill",
+        start_date=datetime(2019, 1, 1),
+        description="Reprocess the Xero event log data of single months",
+        schedule_interval="@monthly",
+        catchup=False,
+        max_active_runs=BACKFILL_MAX_ACTIVE_RUNS,
+    ),
+    window=BACKFILL_WINDOW,
+)
@@ -0,0 +1,3 @@
+-- Run by the datawarehouse container on its first start (an empty volume), so
+-- Airflow's metadata lives in its own database rather than the warehouse's
+CREATE DATABASE airflow;
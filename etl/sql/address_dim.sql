@@ -0,0 +1,24 @@
+-- table: address_dim
+-- description: Each distinct signup address, parsed once into its parts
+-- notes: Addresses are parsed in python by `libraries/address.py`, the province
+--     falling back to the one of the postal code's FSA (from
+--     `etl/reference/fsa_province.csv`). Only addresses not in the table yet
+--     are parsed on each run.
+-- table_type: "silver"
+-- materialization: dimension
+-- key: address
+-- parser: libraries.address.parse_address
+-- indexes:
+--      province: province
+-- columns:
+--      address: TEXT
+--      street: TEXT
+--      city: TEXT
+--      province: TEXT
+--      postal_code: TEXT
+--      fsa: TEXT
+--      fsa_province: TEXT
+
+
+SELECT address
+FROM signup
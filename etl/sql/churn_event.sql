@@ -1,9 +1,26 @@
 -- table: churn_event
 -- description: Measures the users that have churned and at what time did they last login
+-- notes: Built incrementally by templates/inactivity.sql, which keeps every
+--     account's last login and only looks at new logins and at accounts that
+--     just passed 30 days without one. Logins loaded late (or changed by a
+--     reloaded file) rebuild the churns from 30 days before the earliest of
+--     them. The query below is the equivalent full definition of the table.
+--     A windowed run (eg. of the backfill DAG) only rebuilds the churns of its
+--     window, looking for each account's next login up to 30 days past the
+--     window's end; before the state exists it builds the whole table
+--     instead. An account churns at most once per login (a unique key on
+--     account and churn_date).
 -- table_type: "silver"
+-- materialization: inactivity
+-- source: login
+-- key: account
+-- event_time: date
+-- inactive_after: 30 days
+-- indexes:
+--      account: account
 -- columns:
 --      account: TEXT
---      date: TIMESTAMP
+--      churn_date: TIMESTAMPTZ
 
 
 -- Get next login and default it to future date to force churn in cases without a next login
@@ -0,0 +1,55 @@
+-- table: churn_rollup
+-- description: Churned accounts, active accounts and churn rate per day, week
+--     and month (EST), for the dashboard's granularity and date range controls
+-- notes: Every granularity comes from a single read of login and churn_event.
+--     Churns are only emitted once an account has gone 30 days without a
+--     login, so the periods of the last three months are rebuilt on each run.
+-- table_type: "gold"
+-- materialization: incremental
+-- incremental_key: period
+-- lookback: 3 months
+-- sort_key: granularity, period
+-- indexes:
+--      granularity_period: granularity, period
+-- columns:
+--      granularity: TEXT
+--      period: TIMESTAMP
+--      churned_accounts: INTEGER
+--      active_accounts: INTEGER
+--      churn_rate: NUMERIC
+
+
+WITH granularities AS (
+    SELECT granularity
+    FROM (VALUES ('day'), ('week'), ('month')) AS g (granularity)
+),
+
+active_accounts AS (
+    SELECT
+        g.granularity,
+        DATE_TRUNC(g.granularity, l.date AT TIME ZONE 'EST') AS period,
+        COUNT(DISTINCT l.account) AS accounts
+    FROM login AS l
+    CROSS JOIN granularities AS g
+    GROUP BY 1, 2
+),
+
+churned_accounts AS (
+    SELECT
+        g.granularity,
+        DATE_TRUNC(g.granularity, ce.churn_date AT TIME ZONE 'EST') AS period,
+        COUNT(DISTINCT ce.account) AS churned_accounts
+    FROM churn_event AS ce
+    CROSS JOIN granularities AS g
+    GROUP BY 1, 2
+)
+
+SELECT
+    granularity,
+    period,
+    COALESCE(churned_accounts, 0) AS churned_accounts,
+    COALESCE(accounts, 0) AS active_accounts,
+    1.0 * COALESCE(churned_accounts, 0) / NULLIF(accounts, 0) AS churn_rate
+FROM active_accounts AS aa
+FULL JOIN churned_accounts AS ca
+    USING (granularity, period)
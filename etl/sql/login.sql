@@ -1,19 +1,26 @@
 -- table: login
 -- description: Each LOGIN event is logged in this table
 -- table_type: "bronze"
+-- materialization: incremental
+-- incremental_key: date
+-- log_type: LOGIN
+-- sort_key: date
+-- indexes:
+--      date: date
+--      account_date: account, date
 -- columns:
---      date: TIMESTAMP
+--      date: TIMESTAMPTZ
 --      account: TEXT
 --      level: TEXT
 --      details: TEXT
 
 
 SELECT
-    (raw->>'date')::TIMESTAMP AS date,
-    (raw->>'account') AS account,
-    (raw->>'level') AS level,
-    (raw->>'details') AS details
-FROM logs
-WHERE raw->>'log_type' = 'LOGIN'
+    date,
+    account,
+    level,
+    (payload->>'details') AS details
+FROM events
+WHERE log_type = 'LOGIN'
 
 
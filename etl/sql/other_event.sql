@@ -0,0 +1,23 @@
+-- table: other_event
+-- description: Every event with a log_type that no other bronze table takes (eg. UPLOAD, PAGE_ACCESS)
+-- notes: Only built through the bronze fan-out, which keeps the log_types
+--     routed to the other bronze tables out of it
+-- table_type: "bronze"
+-- materialization: incremental
+-- incremental_key: date
+-- log_type: "*"
+-- columns:
+--      date: TIMESTAMPTZ
+--      log_type: TEXT
+--      account: TEXT
+--      level: TEXT
+--      payload: JSONB
+
+
+SELECT
+    date,
+    log_type,
+    account,
+    level,
+    payload
+FROM events
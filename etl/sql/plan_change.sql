@@ -1,22 +1,25 @@
 -- table: plan_change
 -- description: Each PLAN_CHANGE event is logged in this table
 -- table_type: "bronze"
+-- materialization: incremental
+-- incremental_key: date
+-- log_type: PLAN_CHANGE
 -- columns:
---      date: TIMESTAMP
+--      date: TIMESTAMPTZ
 --      account: TEXT
 --      level: TEXT
---      details_change_date: TIMESTAMP
+--      details_change_date: TIMESTAMPTZ
 --      details_from: TEXT
 --      details_to: TEXT
 
 
 SELECT
-    (raw->>'date')::TIMESTAMP AS date,
-    (raw->>'account') AS account,
-    (raw->>'level') AS level,
-    (raw->'details'->>'change_date')::TIMESTAMP AS details_change_date,
-    (raw->'details'->>'from') AS details_from,
-    (raw->'details'->>'to') AS details_to
-FROM logs
-WHERE raw->>'log_type' = 'PLAN_CHANGE'
+    date,
+    account,
+    level,
+    (payload->'details'->>'change_date')::TIMESTAMPTZ AS details_change_date,
+    (payload->'details'->>'from') AS details_from,
+    (payload->'details'->>'to') AS details_to
+FROM events
+WHERE log_type = 'PLAN_CHANGE'
 
@@ -0,0 +1,19 @@
+-- table: plan_change_summary
+-- description: Customers changing from their signup plan to another and the average days it took
+-- table_type: "gold"
+-- columns:
+--      plan_change: TEXT
+--      customers: INTEGER
+--      avg_days_to_change: NUMERIC
+
+
+SELECT
+    pc.details_from || ' to ' || pc.details_to AS plan_change,
+    COUNT(DISTINCT pc.account) AS customers,
+    AVG(DATE_PART('day',
+            (pc.details_change_date - signup.date)
+        )) AS avg_days_to_change
+FROM plan_change AS pc
+INNER JOIN signup
+    USING (account)
+GROUP BY 1
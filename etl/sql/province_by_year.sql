@@ -7,6 +7,11 @@
 --     '2019-05-11' and thus at the yearly aggregatation we'd get a different
 --     result)
 -- table_type: "gold"
+-- materialization: incremental
+-- incremental_key: year
+-- lookback: 1 year
+-- indexes:
+--      year: year
 -- columns:
 --      year: TIMESTAMP
 --      province: TEXT
@@ -1,8 +1,13 @@
 -- table: signup
 -- description: Each SIGNUP event is logged in this table
 -- table_type: "bronze"
+-- materialization: incremental
+-- incremental_key: date
+-- log_type: SIGN_UP
+-- indexes:
+--      account: account
 -- columns:
---      date: TIMESTAMP
+--      date: TIMESTAMPTZ
 --      account: TEXT
 --      level: TEXT
 --      plan: TEXT
@@ -12,14 +17,14 @@
 
 
 SELECT
-    (raw->>'date')::TIMESTAMP AS date,
-    (raw->>'account') AS account,
-    (raw->>'level') AS level,
-    (raw->>'plan') AS plan,
-    (raw->>'firstname') AS firstname,
-    (raw->>'lastname') AS lastname,
-    (raw->>'address') AS address
-FROM logs
-WHERE raw->>'log_type' = 'SIGN_UP'
+    date,
+    account,
+    level,
+    (payload->>'plan') AS plan,
+    (payload->>'firstname') AS firstname,
+    (payload->>'lastname') AS lastname,
+    (payload->>'address') AS address
+FROM events
+WHERE log_type = 'SIGN_UP'
 
 
@@ -0,0 +1,15 @@
+-- table: signup_plan_distribution
+-- description: Customers signing up to each plan and their share of all signups
+-- table_type: "gold"
+-- columns:
+--      plan: TEXT
+--      signups: INTEGER
+--      percent_of_signups: NUMERIC
+
+
+SELECT
+    plan,
+    COUNT(DISTINCT account) AS signups,
+    100.0 * COUNT(DISTINCT account) / SUM(COUNT(DISTINCT account)) OVER () AS percent_of_signups
+FROM signup
+GROUP BY 1
@@ -0,0 +1,31 @@
+{% if full_refresh -%}
+DROP TABLE IF EXISTS public.{{ table_name }};
+
+{% endif -%}
+CREATE TABLE IF NOT EXISTS public.{{ table_name }} (
+    {%- for column, type in columns.items() %}
+    {{ column }} {{ type }}{% if column == metadata.key %} PRIMARY KEY{% endif %}{% if not loop.last %},{% endif %}
+    {%- endfor %}
+);
+{% for index, columns in indexes.items() %}
+CREATE INDEX IF NOT EXISTS {{ index }} ON public.{{ table_name }} ({{ columns }});
+{%- endfor %}
+
+-- Keys not in the dimension yet; `extend_dimension` parses them into it
+CREATE TEMP TABLE _new_{{ table_name }} ON COMMIT DROP AS
+SELECT DISTINCT {{ metadata.key }} AS key
+FROM (
+-- QUERY START --
+{{ sql }}
+-- QUERY END --
+) AS query
+WHERE {{ metadata.key }} IS NOT NULL
+    AND NOT EXISTS (
+        SELECT 1 FROM public.{{ table_name }} AS dimension
+        WHERE dimension.{{ metadata.key }} = query.{{ metadata.key }}
+    );
+
+-- What this build produced (a row per new key), for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows)
+SELECT '{{ table_name }}', COUNT(*)
+FROM _new_{{ table_name }};
@@ -0,0 +1,129 @@
+{% for table in tables -%}
+{% if table.incremental -%}
+CREATE TABLE IF NOT EXISTS public.{{ table.name }} (
+    {%- for column, type in table.columns.items() %}
+    {{ column }} {{ type }}{% if not loop.last %},{% endif %}
+    {%- endfor %}
+);
+{%- for index, columns in table.indexes.items() %}
+CREATE INDEX IF NOT EXISTS {{ index }} ON public.{{ table.name }} ({{ columns }});
+{%- endfor %}
+
+{% if window -%}
+-- Rows from the window's start (less the lookback) to its end are rebuilt
+CREATE TEMP TABLE _watermark_{{ table.name }} ON COMMIT DROP AS
+SELECT
+    CAST('{{ window.start }}' AS {{ table.incremental_key_type }}) - INTERVAL '{{ table.lookback }}' AS value,
+    CAST('{{ window.end }}' AS {{ table.incremental_key_type }}) AS end_value;
+{%- else -%}
+-- Rows from the high-water mark (less the lookback) onwards are rebuilt, or
+-- from the earliest event the loads since the last build changed if sooner
+CREATE TEMP TABLE _watermark_{{ table.name }} ON COMMIT DROP AS
+SELECT COALESCE(
+    {%- if table.changed_from %}
+    LEAST(
+        MAX({{ table.incremental_key }}),
+        CAST('{{ table.changed_from }}' AS {{ table.incremental_key_type }})
+    ) - INTERVAL '{{ table.lookback }}',
+    {%- else %}
+    MAX({{ table.incremental_key }}) - INTERVAL '{{ table.lookback }}',
+    {%- endif %}
+    '-infinity'
+) AS value
+FROM public.{{ table.name }};
+{%- endif %}
+
+{% endif -%}
+DROP TABLE IF EXISTS public._staging_{{ table.name }};
+CREATE TABLE public._staging_{{ table.name }} (
+    {%- for column, type in table.columns.items() %}
+    {{ column }} {{ type }}{% if not loop.last %},{% endif %}
+    {%- endfor %}
+);
+
+{% endfor -%}
+
+-- Read {{ source }} once; each table below is routed from these rows
+{% if explain -%}
+EXPLAIN (ANALYZE, BUFFERS)
+{% endif -%}
+WITH {{ source }} AS MATERIALIZED (
+    SELECT * FROM public.{{ source }}
+    {%- if source_key %}
+    WHERE {{ source_key }} >= (
+        SELECT MIN(value) FROM (
+            {%- for table in tables %}
+            SELECT value FROM _watermark_{{ table.name }}{% if not loop.last %} UNION ALL{% endif %}
+            {%- endfor %}
+        ) AS watermarks
+    )
+    {%- if window %}
+        -- A constant, so only the window's partitions are scanned
+        AND {{ source_key }} < '{{ window.end }}'
+    {%- endif %}
+    {%- endif %}
+)
+{%- for table in tables %},
+
+_insert_{{ table.name }} AS (
+    INSERT INTO public._staging_{{ table.name }} ({{ table.columns.keys() | join(', ') }})
+    SELECT * FROM (
+    -- QUERY START --
+    {{ table.sql }}
+    -- QUERY END --
+    ) AS query
+    WHERE TRUE
+    {%- if table.log_type == '*' %}
+        AND log_type NOT IN ('{{ log_types | join("', '") }}')
+    {%- endif %}
+    {%- if table.incremental %}
+        AND {{ table.incremental_key }} >= (SELECT value FROM _watermark_{{ table.name }})
+    {%- endif %}
+    {%- if table.incremental and window %}
+        AND {{ table.incremental_key }} < (SELECT end_value FROM _watermark_{{ table.name }})
+    {%- endif %}
+    {%- if table.sort_key %}
+    ORDER BY {{ table.sort_key }}
+    {%- endif %}
+    RETURNING pg_column_size(_staging_{{ table.name }}.*) AS bytes
+)
+{%- endfor %}
+
+-- What this build produced, for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows, bytes)
+{%- for table in tables %}
+SELECT '{{ table.name }}', COUNT(*), SUM(bytes) FROM _insert_{{ table.name }}
+{%- if not loop.last %}
+UNION ALL
+{%- endif %}
+{%- endfor %};
+{%- if not explain %}
+
+{% for table in tables if not table.incremental -%}
+{% for index, columns in table.indexes.items() -%}
+CREATE INDEX _staging_{{ index }} ON public._staging_{{ table.name }} ({{ columns }});
+{% endfor %}
+{%- endfor %}
+BEGIN;
+
+{% for table in tables -%}
+{% if table.incremental -%}
+DELETE FROM public.{{ table.name }}
+WHERE {{ table.incremental_key }} >= (SELECT value FROM _watermark_{{ table.name }})
+{%- if window %}
+    AND {{ table.incremental_key }} < (SELECT end_value FROM _watermark_{{ table.name }})
+{%- endif %};
+INSERT INTO public.{{ table.name }} SELECT * FROM public._staging_{{ table.name }};
+DROP TABLE public._staging_{{ table.name }};
+{%- else -%}
+ALTER TABLE IF EXISTS public.{{ table.name }} RENAME TO _backup_{{ table.name }};
+ALTER TABLE IF EXISTS public._staging_{{ table.name }} RENAME TO {{ table.name }};
+DROP TABLE IF EXISTS public._backup_{{ table.name }};
+{%- for index in table.indexes %}
+ALTER INDEX public._staging_{{ index }} RENAME TO {{ index }};
+{%- endfor %}
+{%- endif %}
+
+{% endfor -%}
+COMMIT;
+{%- endif %}
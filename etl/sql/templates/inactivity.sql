@@ -0,0 +1,210 @@
+{%- set key_column, time_column = columns.keys() | list -%}
+{%- set unique_index = table_name ~ "_" ~ key_column ~ "_" ~ time_column ~ "_key" -%}
+{% if full_refresh -%}
+DROP TABLE IF EXISTS public.{{ table_name }};
+DROP TABLE IF EXISTS public._state_{{ table_name }};
+
+{% endif -%}
+CREATE TABLE IF NOT EXISTS public.{{ table_name }} (
+    {%- for column, type in columns.items() %}
+    {{ column }} {{ type }}{% if not loop.last %},{% endif %}
+    {%- endfor %}
+);
+{% for index, columns in indexes.items() %}
+CREATE INDEX IF NOT EXISTS {{ index }} ON public.{{ table_name }} ({{ columns }});
+{%- endfor %}
+
+-- A key is inactive at most once per event, however its churns were built
+DO $$
+BEGIN
+    -- Tables from before the unique key can hold duplicates
+    IF to_regclass('public.{{ unique_index }}') IS NULL THEN
+        DELETE FROM public.{{ table_name }} AS a
+        USING public.{{ table_name }} AS b
+        WHERE a.ctid < b.ctid
+            AND a.{{ key_column }} = b.{{ key_column }}
+            AND a.{{ time_column }} = b.{{ time_column }};
+    END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS {{ unique_index }}
+    ON public.{{ table_name }} ({{ key_column }}, {{ time_column }});
+
+-- The last event of every key and whether its inactivity was already emitted
+CREATE TABLE IF NOT EXISTS public._state_{{ table_name }} (
+    key TEXT PRIMARY KEY,
+    last_seen TIMESTAMPTZ NOT NULL,
+    emitted BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE INDEX IF NOT EXISTS _state_{{ table_name }}_last_seen_idx
+    ON public._state_{{ table_name }} (last_seen);
+
+{% if window -%}
+BEGIN;
+
+-- Only the gaps starting in the window are rebuilt, from its events and the
+-- ones up to the threshold past its end (where a key's next event can be).
+-- The state is about every key's latest event, so it is left as is; a
+-- windowed run only happens once a whole build has made it (`create_table`).
+DELETE FROM public.{{ table_name }}
+WHERE {{ time_column }} >= '{{ window.start }}'
+    AND {{ time_column }} < '{{ window.end }}';
+
+WITH inserted AS (
+    INSERT INTO public.{{ table_name }} ({{ key_column }}, {{ time_column }})
+    SELECT key, event_time
+    FROM (
+        SELECT
+            {{ metadata.key }} AS key,
+            {{ metadata.event_time }} AS event_time,
+            LEAD({{ metadata.event_time }}) OVER (
+                PARTITION BY {{ metadata.key }} ORDER BY {{ metadata.event_time }}
+            ) AS next_time
+        FROM public.{{ metadata.source }}
+        WHERE {{ metadata.event_time }} >= '{{ window.start }}'
+            AND {{ metadata.event_time }} <= TIMESTAMPTZ '{{ window.end }}'
+                + INTERVAL '{{ metadata.inactive_after }}'
+    ) AS gaps
+    WHERE event_time < '{{ window.end }}'
+        AND (
+            next_time IS NULL
+            OR next_time - event_time > INTERVAL '{{ metadata.inactive_after }}'
+        )
+        -- A key without a next event is only inactive once the threshold has
+        -- passed in the data, as in the incremental build
+        AND event_time < (
+            SELECT MAX({{ metadata.event_time }}) FROM public.{{ metadata.source }}
+        ) - INTERVAL '{{ metadata.inactive_after }}'
+    ON CONFLICT ({{ key_column }}, {{ time_column }}) DO NOTHING
+    RETURNING pg_column_size({{ table_name }}.*) AS bytes
+)
+-- What this build produced, for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows, bytes)
+SELECT '{{ table_name }}', COUNT(*), SUM(bytes)
+FROM inserted;
+
+COMMIT;
+{%- else -%}
+BEGIN;
+
+-- The increment starts past the latest event in the state. If the loads since
+-- the last build changed events before it (late lines, a reloaded file), the
+-- churns from the threshold before the earliest of them on are rebuilt too,
+-- and all of them without a state to build on
+CREATE TEMP TABLE _watermark_{{ table_name }} ON COMMIT DROP AS
+SELECT
+    last_seen,
+    CASE
+        WHEN last_seen IS NULL THEN TIMESTAMPTZ '-infinity'
+        {%- if changed_from %}
+        WHEN TIMESTAMPTZ '{{ changed_from }}' <= last_seen
+            THEN TIMESTAMPTZ '{{ changed_from }}'
+                - INTERVAL '{{ metadata.inactive_after }}'
+        {%- endif %}
+    END AS rebuild_from
+FROM (
+    SELECT MAX(last_seen) AS last_seen FROM public._state_{{ table_name }}
+) AS state;
+
+DELETE FROM public.{{ table_name }}
+WHERE {{ time_column }} >= (SELECT rebuild_from FROM _watermark_{{ table_name }});
+
+-- Keys seen since then go back to their last event before it, emitted if a
+-- churn (from before then) is on it
+CREATE TEMP TABLE _rollback_{{ table_name }} ON COMMIT DROP AS
+SELECT key
+FROM public._state_{{ table_name }}
+WHERE last_seen >= (SELECT rebuild_from FROM _watermark_{{ table_name }});
+
+DELETE FROM public._state_{{ table_name }}
+WHERE key IN (SELECT key FROM _rollback_{{ table_name }});
+
+INSERT INTO public._state_{{ table_name }} (key, last_seen, emitted)
+SELECT DISTINCT ON (source.{{ metadata.key }})
+    source.{{ metadata.key }},
+    source.{{ metadata.event_time }},
+    EXISTS (
+        SELECT 1 FROM public.{{ table_name }} AS churn
+        WHERE churn.{{ key_column }} = source.{{ metadata.key }}
+            AND churn.{{ time_column }} = source.{{ metadata.event_time }}
+    )
+FROM public.{{ metadata.source }} AS source
+WHERE source.{{ metadata.key }} IN (SELECT key FROM _rollback_{{ table_name }})
+    AND source.{{ metadata.event_time }} < (
+        SELECT rebuild_from FROM _watermark_{{ table_name }}
+    )
+ORDER BY source.{{ metadata.key }}, source.{{ metadata.event_time }} DESC;
+
+-- Events newer than everything already folded into the state, and the ones
+-- from where it was rolled back
+CREATE TEMP TABLE _new_{{ table_name }} ON COMMIT DROP AS
+SELECT
+    {{ metadata.key }} AS key,
+    {{ metadata.event_time }} AS event_time
+FROM public.{{ metadata.source }}
+WHERE {{ metadata.event_time }} > (
+        SELECT COALESCE(last_seen, '-infinity') FROM _watermark_{{ table_name }}
+    )
+    OR {{ metadata.event_time }} >= (
+        SELECT rebuild_from FROM _watermark_{{ table_name }}
+    );
+
+-- Gaps longer than the threshold between a key's consecutive events, counting
+-- from its last event in the state
+WITH inserted AS (
+    INSERT INTO public.{{ table_name }} ({{ key_column }}, {{ time_column }})
+    SELECT key, event_time
+    FROM (
+        SELECT
+            key,
+            event_time,
+            LEAD(event_time) OVER (PARTITION BY key ORDER BY event_time) AS next_time
+        FROM (
+            SELECT key, last_seen AS event_time
+            FROM public._state_{{ table_name }}
+            WHERE NOT emitted
+                AND key IN (SELECT key FROM _new_{{ table_name }})
+            UNION ALL
+            SELECT key, event_time
+            FROM _new_{{ table_name }}
+        ) AS key_events
+    ) AS gaps
+    WHERE next_time - event_time > INTERVAL '{{ metadata.inactive_after }}'
+    ON CONFLICT ({{ key_column }}, {{ time_column }}) DO NOTHING
+    RETURNING pg_column_size({{ table_name }}.*) AS bytes
+)
+-- What this build produced, for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows, bytes)
+SELECT '{{ table_name }}', COUNT(*), SUM(bytes)
+FROM inserted;
+
+INSERT INTO public._state_{{ table_name }} (key, last_seen)
+SELECT key, MAX(event_time)
+FROM _new_{{ table_name }}
+GROUP BY key
+ON CONFLICT (key) DO UPDATE SET
+    last_seen = EXCLUDED.last_seen,
+    emitted = FALSE;
+
+-- Keys whose last event is now more than the threshold before the latest event
+WITH inactive AS (
+    UPDATE public._state_{{ table_name }}
+    SET emitted = TRUE
+    WHERE NOT emitted
+        AND last_seen < (
+            SELECT MAX(last_seen) FROM public._state_{{ table_name }}
+        ) - INTERVAL '{{ metadata.inactive_after }}'
+    RETURNING key, last_seen
+),
+inserted AS (
+    INSERT INTO public.{{ table_name }} ({{ key_column }}, {{ time_column }})
+    SELECT key, last_seen
+    FROM inactive
+    ON CONFLICT ({{ key_column }}, {{ time_column }}) DO NOTHING
+    RETURNING pg_column_size({{ table_name }}.*) AS bytes
+)
+INSERT INTO _build_metrics (target, rows, bytes)
+SELECT '{{ table_name }}', COUNT(*), SUM(bytes)
+FROM inserted;
+
+COMMIT;
+{%- endif %}
@@ -0,0 +1,66 @@
+CREATE TABLE IF NOT EXISTS public.{{ table_name }} AS
+SELECT * FROM (
+-- QUERY START --
+{{ sql }}
+-- QUERY END --
+) AS query
+WITH NO DATA;
+{% for index, columns in indexes.items() %}
+CREATE INDEX IF NOT EXISTS {{ index }} ON public.{{ table_name }} ({{ columns }});
+{%- endfor %}
+
+BEGIN;
+
+{% if window -%}
+-- Rows from the window's start (less the lookback) to its end are rebuilt
+CREATE TEMP TABLE _watermark_{{ table_name }} ON COMMIT DROP AS
+SELECT
+    CAST('{{ window.start }}' AS {{ incremental_key_type }}) - INTERVAL '{{ lookback }}' AS value,
+    CAST('{{ window.end }}' AS {{ incremental_key_type }}) AS end_value;
+{%- else -%}
+-- Rows from the high-water mark (less the lookback) onwards are rebuilt, or
+-- from the earliest event the loads since the last build changed if sooner
+CREATE TEMP TABLE _watermark_{{ table_name }} ON COMMIT DROP AS
+SELECT COALESCE(
+    {%- if changed_from %}
+    LEAST(
+        MAX({{ incremental_key }}),
+        CAST('{{ changed_from }}' AS {{ incremental_key_type }})
+    ) - INTERVAL '{{ lookback }}',
+    {%- else %}
+    MAX({{ incremental_key }}) - INTERVAL '{{ lookback }}',
+    {%- endif %}
+    '-infinity'
+) AS value
+FROM public.{{ table_name }};
+{%- endif %}
+
+CREATE TEMP TABLE _increment_{{ table_name }} ON COMMIT DROP AS
+SELECT * FROM (
+-- QUERY START --
+{{ sql }}
+-- QUERY END --
+) AS query
+WHERE {{ incremental_key }} >= (SELECT value FROM _watermark_{{ table_name }})
+{%- if window %}
+    AND {{ incremental_key }} < (SELECT end_value FROM _watermark_{{ table_name }})
+{%- endif %};
+
+DELETE FROM public.{{ table_name }}
+WHERE {{ incremental_key }} >= (SELECT value FROM _watermark_{{ table_name }})
+{%- if window %}
+    AND {{ incremental_key }} < (SELECT end_value FROM _watermark_{{ table_name }})
+{%- endif %};
+
+INSERT INTO public.{{ table_name }}
+SELECT * FROM _increment_{{ table_name }}
+{%- if sort_key %}
+ORDER BY {{ sort_key }}
+{%- endif %};
+
+-- What this build produced, for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows, bytes)
+SELECT '{{ table_name }}', COUNT(*), SUM(pg_column_size(increment.*))
+FROM _increment_{{ table_name }} AS increment;
+
+COMMIT;
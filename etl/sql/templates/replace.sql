@@ -1,15 +1,33 @@
 DROP TABLE IF EXISTS public._staging_{{ table_name }};
 
 CREATE TABLE public._staging_{{ table_name }} AS 
+{%- if sort_key %}
+SELECT * FROM (
+{%- endif %}
 -- QUERY START --
 {{ sql }}
 -- QUERY END --
+{%- if sort_key %}
+) AS query
+ORDER BY {{ sort_key }}
+{%- endif %}
 ;
+{% for index, columns in indexes.items() %}
+CREATE INDEX _staging_{{ index }} ON public._staging_{{ table_name }} ({{ columns }});
+{%- endfor %}
+
+-- What this build produced, for `record_run_metrics`
+INSERT INTO _build_metrics (target, rows, bytes)
+SELECT '{{ table_name }}', COUNT(*), SUM(pg_column_size(staging.*))
+FROM public._staging_{{ table_name }} AS staging;
 
 BEGIN;
 
 ALTER TABLE IF EXISTS public.{{ table_name }} RENAME TO _backup_{{ table_name }};
 ALTER TABLE IF EXISTS public._staging_{{ table_name }} RENAME TO {{ table_name }};
 DROP TABLE IF EXISTS public._backup_{{ table_name }};
+{%- for index in indexes %}
+ALTER INDEX public._staging_{{ index }} RENAME TO {{ index }};
+{%- endfor %}
 
 COMMIT;
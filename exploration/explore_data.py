@@ -3,11 +3,24 @@ This is a first pass at examining the data and the problems.
 
 The point of this was to use Pandas as a quick way to start planning out
 possible difficulties with doing the selected analyses. It does not represent
-production-ready code.
+production-ready code. See `stream_data.py` for a bounded memory version that
+follows the warehouse definitions.
 """
 
+import hashlib
+import json
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+
+from libraries.address import parse_address
+
+# Parsed log files are cached here as Arrow IPC files, keyed by mtime and hash
+CACHE_FOLDER = os.getenv("EXPLORATION_CACHE_DIR", "data/.cache")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
 
 
 def get_df_from_log_file(filename):
@@ -21,8 +34,70 @@ def get_df_from_log_file(filename):
 
 
 def get_list_of_data_files(folder="data"):
-    files = os.listdir(folder)
-    return [f"{folder}/{filename}" for filename in files]
+    files = [f for f in os.listdir(folder) if f.endswith(".log")]
+    return [f"{folder}/{filename}" for filename in sorted(files)]
+
+
+def cache_path(datafile):
+    """The cache file for this version of `datafile`"""
+    with open(datafile, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    name = os.path.basename(datafile)
+    mtime = os.stat(datafile).st_mtime_ns
+    return os.path.join(CACHE_FOLDER, f"{name}-{mtime}-{digest}.arrow")
+
+
+def write_cache(df, datafile, path):
+    """Store `df` as an Arrow file; `details` is a str or a dict so keep it as JSON"""
+    df = df.copy()
+    df["details"] = df.details.map(json.dumps, na_action="ignore")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    # Drop the caches of older versions of this file
+    name = os.path.basename(datafile)
+    for stale in os.listdir(CACHE_FOLDER):
+        if stale.startswith(f"{name}-") and stale.endswith(".arrow"):
+            os.remove(os.path.join(CACHE_FOLDER, stale))
+
+    # Write then rename, so a reader never sees half a file
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_FOLDER, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        writer = pa.ipc.new_file(f, table.schema)
+        writer.write_table(table)
+        writer.close()
+    os.replace(tmp_path, path)
+
+
+def read_cache(path):
+    with pa.memory_map(path) as source:
+        df = pa.ipc.open_file(source).read_all().to_pandas()
+    df["details"] = df.details.map(json.loads, na_action="ignore")
+    return df
+
+
+def parse_to_cache(datafile, path):
+    df = get_df_from_log_file(datafile)
+    write_cache(df, datafile, path)
+    return df
+
+
+def get_dfs_from_log_files(datafiles, workers=PARSE_WORKERS):
+    """Read each log file from its cache, parsing the uncached ones in parallel"""
+    paths = {datafile: cache_path(datafile) for datafile in datafiles}
+    dfs = {
+        datafile: read_cache(path)
+        for datafile, path in paths.items()
+        if os.path.exists(path)
+    }
+
+    missing = [datafile for datafile in datafiles if datafile not in dfs]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = pool.map(parse_to_cache, missing, [paths[f] for f in missing])
+            dfs.update(zip(missing, parsed))
+
+    return [dfs[datafile] for datafile in datafiles]
 
 
 def get_churn_df(df):
@@ -168,22 +243,9 @@ def analyze_geo(df):
         """
     )
 
-    def province_parser(address: str) -> str:
-        """This really only works because of assumptions
-
-        Needed to handle edgecases:
-            * Postal code is not seperated from province
-            * not every address has same spacing between fields (Whitehose)
-        """
-        remove_postal_code = address.split(" ")[:-2]
-        province_info = remove_postal_code[-1]
-        if len(province_info) > 2:
-            print(province_info)
-            province_info = province_info[-2:]
-        return province_info
-
     signups = df[df.log_type == "SIGN_UP"].dropna(axis=1)
-    signups["province"] = signups.address.apply(province_parser)
+    # The same parser that fills `address_dim` in the warehouse
+    signups["province"] = signups.address.map(lambda a: parse_address(a).province)
     signups = signups[["account", "province"]]
     print("All signups:")
     print(signups.groupby("province").nunique()["account"])
@@ -196,11 +258,12 @@ def analyze_geo(df):
 
 
 def main():
-    df = None
-    for datafile in get_list_of_data_files():
-        datafile_df = get_df_from_log_file(datafile)
+    # Concatenate once at the end, concatenating per file copies the data each time
+    datafiles = get_list_of_data_files()
+    datafile_dfs = get_dfs_from_log_files(datafiles)
+    for datafile, datafile_df in zip(datafiles, datafile_dfs):
         print(f"{datafile}: {datafile_df.count().to_dict()}")
-        df = pd.concat([df, datafile_df], ignore_index=True, sort=False)
+    df = pd.concat(datafile_dfs, ignore_index=True, sort=False)
 
     # Check the log_types
     log_types = df.log_type.unique().tolist()
@@ -0,0 +1,227 @@
+"""
+A single pass, bounded memory version of the analyses in `explore_data.py`.
+
+The log files are merged into one stream ordered by date and folded into a
+small state object per account (last login, signup plan, province), so memory
+grows with the number of accounts and not with the number of events. The
+results follow the warehouse definitions (`etl/sql`), which makes this a quick
+way to check the dashboard numbers against raw logs without a database.
+
+This can be run from the root folder via:
+    `venv/bin/python -m exploration.stream_data [data_folder]`
+"""
+
+import heapq
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+from libraries.address import parse_address
+
+# Matches `AT TIME ZONE 'EST'` in the warehouse: a fixed offset, no daylight time
+EST = timezone(timedelta(hours=-5))
+CHURN_AFTER = timedelta(days=30).total_seconds()
+
+
+class AccountState:
+    """Everything kept about an account while streaming through the logs"""
+
+    __slots__ = (
+        "last_login",
+        "last_login_month",
+        "churned",
+        "plan",
+        "signup_time",
+        "province",
+        "signup_year",
+    )
+
+    def __init__(self):
+        self.last_login = None
+        self.last_login_month = None
+        self.churned = False
+        self.plan = None
+        self.signup_time = None
+        self.province = None
+        self.signup_year = None
+
+
+def get_list_of_data_files(folder="data"):
+    return sorted(
+        os.path.join(folder, filename)
+        for filename in os.listdir(folder)
+        if filename.endswith(".log")
+    )
+
+
+def read_events(datafile):
+    """Yield (timestamp, event) for each line, checking the file is in date order"""
+    previous = float("-inf")
+    with open(datafile) as f:
+        for line_number, line in enumerate(f, start=1):
+            event = json.loads(line)
+            timestamp = datetime.fromisoformat(event["date"]).timestamp()
+            if timestamp < previous:
+                raise ValueError(f"{datafile}:{line_number} is not in date order")
+            previous = timestamp
+            yield timestamp, event
+
+
+def merge_events(datafiles):
+    """Merge the (already sorted) files into one stream ordered by date"""
+    return heapq.merge(*(read_events(f) for f in datafiles), key=lambda x: x[0])
+
+
+def est_month(timestamp):
+    return datetime.fromtimestamp(timestamp, EST).strftime("%Y-%m")
+
+
+class StreamingAnalysis:
+    """Fold a date ordered event stream into the churn, plan and geo results"""
+
+    def __init__(self):
+        self.accounts = defaultdict(AccountState)
+        self.max_login = float("-inf")
+        self.active_by_month = Counter()
+        self.churn_by_month = Counter()
+        self.plan_changes = defaultdict(lambda: [set(), 0, 0])
+        self.pending_changes = defaultdict(list)
+        self.events = 0
+
+    def add(self, timestamp, event):
+        self.events += 1
+        log_type = event["log_type"]
+        if log_type == "LOGIN":
+            self.add_login(timestamp, event)
+        elif log_type == "SIGN_UP":
+            self.add_signup(timestamp, event)
+        elif log_type == "PLAN_CHANGE":
+            self.add_plan_change(event)
+
+    def add_login(self, timestamp, event):
+        state = self.accounts[str(event["account"])]
+        if state.last_login is not None:
+            if timestamp - state.last_login > CHURN_AFTER:
+                self.churn(state)
+
+        month = est_month(timestamp)
+        if month != state.last_login_month:
+            self.active_by_month[month] += 1
+            state.last_login_month = month
+        state.last_login = timestamp
+        self.max_login = max(self.max_login, timestamp)
+
+    def churn(self, state):
+        self.churn_by_month[est_month(state.last_login)] += 1
+        state.churned = True
+
+    def add_signup(self, timestamp, event):
+        account = str(event["account"])
+        state = self.accounts[account]
+        state.plan = event["plan"]
+        state.signup_time = timestamp
+        # Parsed like `address_dim`, which `user_location` takes the province from
+        state.province = parse_address(event["address"]).province or ""
+        state.signup_year = datetime.fromtimestamp(timestamp, EST).year
+        for change in self.pending_changes.pop(account, []):
+            self.add_plan_change(change)
+
+    def add_plan_change(self, event):
+        account = str(event["account"])
+        state = self.accounts.get(account)
+        if state is None or state.signup_time is None:
+            # Plan changes only count against a signup, which may still be coming
+            self.pending_changes[account].append(event)
+            return
+
+        details = event["details"]
+        change_time = datetime.fromisoformat(details["change_date"]).timestamp()
+        # DATE_PART('day', interval) truncates towards zero
+        days = int((change_time - state.signup_time) / 86400)
+        summary = self.plan_changes[f"{details['from']} to {details['to']}"]
+        summary[0].add(account)
+        summary[1] += days
+        summary[2] += 1
+
+    def finish(self):
+        """Churn the accounts whose last login is over 30 days before the latest"""
+        for state in self.accounts.values():
+            if (
+                state.last_login is not None
+                and self.max_login - state.last_login > CHURN_AFTER
+            ):
+                self.churn(state)
+        return self
+
+    def churn_rates(self):
+        months = sorted(set(self.active_by_month) | set(self.churn_by_month))
+        return [
+            (
+                month,
+                self.churn_by_month[month],
+                self.active_by_month[month],
+                self.churn_by_month[month] / self.active_by_month[month]
+                if self.active_by_month[month]
+                else None,
+            )
+            for month in months
+        ]
+
+    def plan_signups(self):
+        signups = Counter(s.plan for s in self.accounts.values() if s.plan)
+        total = sum(signups.values())
+        return [(plan, n, 100.0 * n / total) for plan, n in sorted(signups.items())]
+
+    def plan_change_summary(self):
+        return [
+            (change, len(accounts), days / count)
+            for change, (accounts, days, count) in sorted(self.plan_changes.items())
+        ]
+
+    def provinces(self):
+        signups, active = Counter(), Counter()
+        for state in self.accounts.values():
+            if state.province is None:
+                continue
+            key = (state.signup_year, state.province)
+            signups[key] += 1
+            active[key] += not state.churned
+        return [
+            (year, province, signups[year, province], active[year, province])
+            for year, province in sorted(signups)
+        ]
+
+
+def analyze(datafiles):
+    analysis = StreamingAnalysis()
+    for timestamp, event in merge_events(datafiles):
+        analysis.add(timestamp, event)
+    return analysis.finish()
+
+
+def main(folder="data"):
+    analysis = analyze(get_list_of_data_files(folder))
+    print(f"{analysis.events} events, {len(analysis.accounts)} accounts")
+
+    print("\nmonth    churned  active  churn_rate")
+    for month, churned, active, rate in analysis.churn_rates():
+        rate = "" if rate is None else f"{rate:.4f}"
+        print(f"{month}  {churned:>7}  {active:>6}  {rate:>10}")
+
+    print("\nplan         signups  percent")
+    for plan, signups, percent in analysis.plan_signups():
+        print(f"{plan:<12} {signups:>7}  {percent:>6.2f}")
+
+    print("\nplan_change                  customers  avg_days")
+    for change, customers, avg_days in analysis.plan_change_summary():
+        print(f"{change:<28} {customers:>9}  {avg_days:>8.2f}")
+
+    print("\nyear  province  signups  active_users")
+    for year, province, signups, active in analysis.provinces():
+        print(f"{year}  {province:<8}  {signups:>7}  {active:>12}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
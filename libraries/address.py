@@ -0,0 +1,72 @@
+"""Parse the signup addresses of the logs into their parts."""
+
+import csv
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Province of each postal code prefix: the first letter of the FSA (forward
+# sortation area, the first half of the code) or, for the territories, all of it
+FSA_REFERENCE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "etl",
+    "reference",
+    "fsa_province.csv",
+)
+
+# eg. `'784 Augusta St., Whitehorse,YT Y1A 1N4'`; the space inside the postal
+# code and the one before the province are not always there
+POSTAL_CODE = re.compile(r"(?:^|[\s,])([A-Z]\d[A-Z])\s?(\d[A-Z]\d)$", re.I)
+PROVINCE = re.compile(r"(?:^|[\s,])([A-Z]{2})$")
+
+Address = namedtuple("Address", "street city province postal_code fsa fsa_province")
+
+
+@lru_cache(maxsize=None)
+def fsa_provinces(path=FSA_REFERENCE):
+    with open(path, newline="") as f:
+        return {row["prefix"]: row["province"] for row in csv.DictReader(f)}
+
+
+def fsa_province(fsa):
+    """The province of an FSA, from the most specific prefix in FSA_REFERENCE."""
+    if not fsa:
+        return None
+    provinces = fsa_provinces()
+    return provinces.get(fsa) or provinces.get(fsa[0])
+
+
+def parse_address(address):
+    """Parse an address into an `Address`, None for the parts it doesn't have.
+
+    The province is the one written in the address, or else the one of its
+    postal code (`fsa_province`, which is always from the postal code).
+    """
+    rest = address.strip().strip("'\"").strip()
+    postal_code = fsa = province = None
+
+    match = POSTAL_CODE.search(rest)
+    if match:
+        fsa = match.group(1).upper()
+        postal_code = f"{fsa} {match.group(2).upper()}"
+        rest = rest[: match.start()].rstrip(" ,")
+
+    match = PROVINCE.search(rest)
+    if match:
+        province = match.group(1)
+        rest = rest[: match.start()].rstrip(" ,")
+
+    # The city is the last part left, unless a missing comma merged it into
+    # the street (eg. `8711 S. Lakewood St. Sylvan Lake, AB T4S 7A0`)
+    parts = [part.strip() for part in rest.split(",") if part.strip()]
+    street, city = None, None
+    if len(parts) > 1:
+        street, city = ", ".join(parts[:-1]), parts[-1]
+    elif parts:
+        street = parts[0]
+
+    postal_province = fsa_province(fsa)
+    return Address(
+        street, city, province or postal_province, postal_code, fsa, postal_province
+    )
@@ -1,14 +1,32 @@
+import gzip
+import hashlib
+import importlib
+import io
 import os
+import queue
+import re
+import threading
+import time
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 from jinja2 import Template
 from sqlalchemy import create_engine
 from sqlalchemy import text
 from sqlalchemy.exc import DBAPIError
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker
 
 from dotenv import load_dotenv
 
+from libraries.log_parser import RejectedLine, parse_event
+
+try:
+    import zstandard
+except ImportError:  # only needed to load .zst archives
+    zstandard = None
+
 load_dotenv()
 
 URI = "postgres://{user}:{password}@{host}:{port}/{db}".format(
@@ -18,16 +36,107 @@ URI = "postgres://{user}:{password}@{host}:{port}/{db}".format(
     port=os.getenv("POSTGRES_PORT"),
     db=os.getenv("POSTGRES_USER"),
 )
-postgres_engine = create_engine(URI)
+postgres_engine = create_engine(
+    URI,
+    pool_size=int(os.getenv("POSTGRES_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", "10")),
+    pool_timeout=int(os.getenv("POSTGRES_POOL_TIMEOUT", "30")),
+    pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE", "1800")),
+    pool_pre_ping=os.getenv("POSTGRES_POOL_PRE_PING", "1") == "1",
+)
+Session = sessionmaker()
 
 PROJECT_ROOT = os.getenv("AIRFLOW_HOME", ".")
 SQL_FOLDER = f"{PROJECT_ROOT}/etl/sql"
 
+# Number of log lines buffered per COPY; bounds loader memory regardless of file size
+COPY_CHUNK_ROWS = int(os.getenv("COPY_CHUNK_ROWS", "10000"))
+
+# Files loaded concurrently; keep within the connection pool (POSTGRES_POOL_SIZE)
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", "4"))
+
+# Log archives are read whole (they are never appended to), decompressed on a
+# thread up to DECOMPRESS_AHEAD blocks ahead of the loader
+ARCHIVE_EXTENSIONS = (".gz", ".zst")
+DECOMPRESS_BLOCK_BYTES = 2 ** 20
+DECOMPRESS_AHEAD = 8
+
+# The columns of `events` (and of the staging table `load_datafile` COPYs into)
+EVENT_COLUMNS = """
+    date TIMESTAMPTZ NOT NULL,
+    log_type TEXT NOT NULL,
+    account TEXT,
+    level TEXT,
+    payload JSONB,
+    source TEXT
+"""
+
+# Processes validating log lines; parsing is CPU bound, so the loader threads
+# hand their chunks of lines to these
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+# Rows fetched per round trip by `stream_query`
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "10000"))
+
+# Bytes hashed from the head of a file and from before its last loaded offset
+CHECKSUM_BYTES = 64 * 1024
+
+
+class PoolStats:
+    """Connection checkouts and the time spent waiting on the pool for them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "avg_wait_seconds": self.total_wait / max(self.checkouts, 1),
+                "max_wait_seconds": self.max_wait,
+                "checked_out": postgres_engine.pool.checkedout(),
+                "pool_status": postgres_engine.pool.status(),
+            }
+
+
+pool_stats = PoolStats()
+
+
+def log_pool_stats():
+    """Print the connection pool's use by this process, at the end of a task
+    (each Airflow task runs in a process of its own)."""
+    stats = pool_stats.as_dict()
+    print(
+        f"Connection pool: {stats['checkouts']} checkouts, waited "
+        f"{stats['avg_wait_seconds']:.4f}s on average and "
+        f"{stats['max_wait_seconds']:.4f}s at most. {stats['pool_status']}"
+    )
+
+
+def checkout(raw=False):
+    """Take a connection (or its DBAPI connection) from the pool, timing the wait."""
+    start = time.perf_counter()
+    connection = postgres_engine.raw_connection() if raw else postgres_engine.connect()
+    pool_stats.record(time.perf_counter() - start)
+    return connection
+
 
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
-    session = scoped_session(sessionmaker(bind=postgres_engine))
+    connection = checkout()
+    session = Session(bind=connection)
     try:
         yield session
         session.commit()
@@ -36,57 +145,1275 @@ def session_scope():
         raise
     finally:
         session.close()
+        connection.close()
 
 
-def create_table(table_name):
-    sql_file = f"{SQL_FOLDER}/{table_name}.sql"
-    with open(sql_file) as f:
-        sql = text(f.read())
+def stream_query(query, params=None, batch_size=STREAM_BATCH_ROWS, connection=None):
+    """Yield the rows of `query` in lists of `batch_size` from a server-side cursor.
 
-    template_file = f"{SQL_FOLDER}/templates/replace.sql"
-    with open(template_file) as f:
-        template = Template(f.read())
+    Only one batch is held in memory at a time, however large the result. It
+    runs on `connection` if given (eg. to read within its transaction), else
+    on a connection of its own.
+    """
+    query = query if hasattr(query, "text") else text(query)
+    owned = connection is None
+    connection = checkout() if owned else connection
+    try:
+        result = connection.execution_options(stream_results=True).execute(
+            query, params or {}
+        )
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        if owned:
+            connection.close()
 
-    with session_scope() as db:
-        query = text(template.render(sql=sql.text, table_name=table_name))
-        print(query)
-        db.execute(query)
 
+@contextmanager
+def raw_connection_scope():
+    """Provide a transactional DBAPI connection for driver-level calls (eg. COPY)."""
+    connection = checkout(raw=True)
+    try:
+        yield connection
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
 
-def extract_log_data():
-    with session_scope() as db:
-        query = text(
+
+def read_sql(table_name):
+    with open(f"{SQL_FOLDER}/{table_name}.sql") as f:
+        return f.read()
+
+
+def read_template(template_name):
+    with open(f"{SQL_FOLDER}/templates/{template_name}.sql") as f:
+        return Template(f.read())
+
+
+def parse_header(sql):
+    """Parse the `-- key: value` comment block at the top of a table's SQL.
+
+    A key without a value (eg. `columns:`) collects the indented `name: value`
+    lines below it into a dict; indented lines under any other key continue its
+    value.
+    """
+    metadata = {}
+    key = None
+    for line in sql.splitlines():
+        if not line.startswith("--"):
+            break
+        content = line[2:]
+        stripped = content.strip()
+        indented = len(content) - len(content.lstrip()) > 1
+        if indented and key:
+            if isinstance(metadata[key], dict):
+                name, _, value = stripped.partition(":")
+                metadata[key][name.strip()] = value.strip().strip('"')
+            else:
+                metadata[key] = f"{metadata[key]} {stripped}"
+        elif ":" in stripped:
+            key, _, value = stripped.partition(":")
+            key, value = key.strip(), value.strip().strip('"')
+            metadata[key] = value if value else {}
+    return metadata
+
+
+def read_table_metadata(table_name):
+    return parse_header(read_sql(table_name))
+
+
+def list_tables():
+    """Every table with a SQL file in SQL_FOLDER."""
+    return sorted(
+        filename[: -len(".sql")]
+        for filename in os.listdir(SQL_FOLDER)
+        if filename.endswith(".sql")
+    )
+
+
+def table_references(sql):
+    """Names following `FROM`/`JOIN` in `sql`, less its CTEs and comments."""
+    sql = re.sub(r"--[^\n]*", "", sql)
+    ctes = re.findall(r"\b(\w+)\s+AS\s+(?:NOT\s+)?(?:MATERIALIZED\s+)?\(", sql, re.I)
+    references = re.findall(r"\b(?:FROM|JOIN)\s+(?:public\.)?(\w+)", sql, re.I)
+    return {name.lower() for name in references} - {name.lower() for name in ctes}
+
+
+def table_dependencies(table_names=None):
+    """The tables each table is built from, `events` for the raw log data.
+
+    Found from the tables named in each query and the `source` header (the
+    table stateful templates read from).
+    """
+    table_names = table_names or list_tables()
+    known = set(list_tables()) | {"events"}
+    dependencies = {}
+    for table_name in table_names:
+        sql = read_sql(table_name)
+        upstream = table_references(sql)
+        upstream.add(parse_header(sql).get("source", table_name))
+        dependencies[table_name] = sorted((upstream & known) - {table_name})
+    return dependencies
+
+
+def build_order(dependencies):
+    """The tables of `dependencies` ordered so each comes after its upstream."""
+    order, done = [], set()
+    remaining = dict(dependencies)
+    while remaining:
+        ready = sorted(
+            table_name
+            for table_name, upstream in remaining.items()
+            if all(u in done or u not in dependencies for u in upstream)
+        )
+        if not ready:
+            raise ValueError(f"Circular dependencies between {sorted(remaining)}")
+        for table_name in ready:
+            order.append(table_name)
+            done.add(table_name)
+            del remaining[table_name]
+    return order
+
+
+def table_indexes(table_name, metadata):
+    """Index names and their columns, from the `indexes` header.
+
+    eg. `account_date: account, date` under `indexes:` in the `login` header is
+    the index `login_account_date_idx` on `(account, date)`.
+    """
+    return {
+        f"{table_name}_{name}_idx": columns
+        for name, columns in metadata.get("indexes", {}).items()
+    }
+
+
+def use_full_refresh(full_refresh=None):
+    if full_refresh is None:
+        return os.getenv("FULL_REFRESH", "0") == "1"
+    return full_refresh
+
+
+Window = namedtuple("Window", "start end")
+
+
+def window_bound(value):
+    """A window bound as a UTC datetime; dates and naive datetimes are UTC."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def parse_window(window_start=None, window_end=None):
+    """The `Window` from `window_start` up to (not including) `window_end`, or
+    None (no window: process everything) when neither is given.
+
+    The bounds can be dates, datetimes or their ISO strings, as Airflow renders
+    `{{ ds }}`.
+    """
+    if window_start is None and window_end is None:
+        return None
+    if window_start is None or window_end is None:
+        raise ValueError("A window needs both a start and an end")
+    window = Window(window_bound(window_start), window_bound(window_end))
+    if window.start >= window.end:
+        raise ValueError(f"Window {window.start} to {window.end} is empty")
+    return window
+
+
+@contextmanager
+def table_locks(table_names):
+    """Hold the build lock of each of `table_names` until the block exits.
+
+    Builds of a table are serialized across processes (eg. concurrent runs of
+    the backfill DAG), as neither their DDL nor the rows of overlapping windows
+    can interleave. The locks are advisory locks on their own connection, taken
+    in name order so that two builders can't deadlock.
+    """
+    connection = checkout().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        for table_name in sorted(table_names):
+            connection.execute(
+                text("SELECT pg_advisory_lock(hashtext(:key))"),
+                {"key": f"build:{table_name}"},
+            )
+        yield
+    finally:
+        try:
+            # Advisory locks outlive the connection's return to the pool
+            connection.execute(text("SELECT pg_advisory_unlock_all()"))
+        finally:
+            connection.close()
+
+
+def use_query_plans(explain=None):
+    # EXPLAIN ANALYZE runs the query a second time, so plans are opt in
+    if explain is None:
+        return os.getenv("CAPTURE_QUERY_PLANS", "0") == "1"
+    return explain
+
+
+def staging_query(
+    db, table_name, sql, metadata, materialization, window=None, changed_from=None
+):
+    """The SELECT that `materialization` builds `table_name` from, if it has one.
+
+    Incremental tables only select the rows past their high-water mark, or
+    from `changed_from` if sooner (see `changed_since_load`), or in the
+    `window`; dimensions the keys to look for new ones in. Stateful templates
+    (eg. `inactivity`) build from their state instead.
+    """
+    if materialization in ("replace", "dimension"):
+        return sql
+    if materialization == "incremental" and window:
+        key = metadata["incremental_key"]
+        key_type = metadata.get("columns", {}).get(key, "TIMESTAMPTZ")
+        lookback = metadata.get("lookback", "0 seconds")
+        return f"""
+            SELECT * FROM (
+            {sql}
+            ) AS query
+            WHERE {key} >= CAST('{window.start}' AS {key_type}) - INTERVAL '{lookback}'
+                AND {key} < CAST('{window.end}' AS {key_type})
             """
-            DROP TABLE IF EXISTS logs;
-            CREATE TABLE logs (raw JSON);
+    if materialization == "incremental":
+        exists = db.execute(
+            text("SELECT to_regclass(:table_name) IS NOT NULL"),
+            {"table_name": f"public.{table_name}"},
+        ).scalar()
+        if not exists:
+            return sql
+        key = metadata["incremental_key"]
+        key_type = metadata.get("columns", {}).get(key, "TIMESTAMPTZ")
+        lookback = metadata.get("lookback", "0 seconds")
+        watermark = f"MAX({key})"
+        if changed_from:
+            watermark = f"LEAST({watermark}, CAST('{changed_from}' AS {key_type}))"
+        return f"""
+            SELECT * FROM (
+            {sql}
+            ) AS query
+            WHERE {key} >= (
+                SELECT COALESCE({watermark} - INTERVAL '{lookback}', '-infinity')
+                FROM public.{table_name}
+            )
             """
+    return None
+
+
+def explain_query(db, query):
+    """The `EXPLAIN (ANALYZE, BUFFERS)` output of `query`, which runs it."""
+    if query is None:
+        return None
+    plan = db.execute(text(f"EXPLAIN (ANALYZE, BUFFERS)\n{query}")).fetchall()
+    return "\n".join(line for line, in plan)
+
+
+def create_table(
+    table_name, full_refresh=None, explain=None, window_start=None, window_end=None
+):
+    """Build `table_name` with the template named by its `materialization` header.
+
+    Tables are rebuilt and swapped in (`replace`) unless they opt into another
+    materialization (`dimension` tables only parse the keys they don't have
+    yet, see `extend_dimension`); `full_refresh` (or FULL_REFRESH=1) rebuilds
+    incremental tables and resets stateful ones. The `indexes` in the header
+    are built before a rebuilt table is swapped in, and rows are written in
+    `sort_key` order. Incremental and stateful tables also rebuild from the
+    earliest event date that the loads since their last build changed (see
+    `changed_since_load`), so files of earlier months, reloaded files and late
+    lines reach them. The build is recorded in `etl_run_metrics`, with the plan
+    of its staging query if `explain` (or CAPTURE_QUERY_PLANS=1).
+
+    Given a window (`window_start` up to `window_end`, see `parse_window`),
+    incremental and stateful tables only rebuild the rows of the window, from
+    its start less their `lookback`, and are never fully refreshed; the other
+    materializations build as usual. A stateful table is built whole instead
+    until it has a state. Builds of a table wait for each other
+    (`table_locks`).
+    """
+    window = parse_window(window_start, window_end)
+    sql = read_sql(table_name)
+    metadata = parse_header(sql)
+    materialization = metadata.get("materialization", "replace")
+    full_refresh = use_full_refresh(full_refresh) and window is None
+    if full_refresh and materialization == "incremental":
+        materialization = "replace"
+    template = read_template(materialization)
+    columns = metadata.get("columns", {})
+    incremental_key = metadata.get("incremental_key")
+
+    upstream = table_dependencies([table_name])[table_name]
+
+    with table_locks([table_name]), session_scope() as db:
+        if window and materialization == "inactivity" and not has_state(db, table_name):
+            # A window's churns are rebuilt against every key's state, which
+            # only a whole build makes
+            print(f"'{table_name}' has no state yet; building it whole")
+            window = None
+        load_id = built_from_load(db, upstream)
+        changed_from = changed_since_load(db, table_name, load_id)
+        query_plan = None
+        if use_query_plans(explain):
+            query_plan = explain_query(
+                db,
+                staging_query(
+                    db,
+                    table_name,
+                    sql,
+                    metadata,
+                    materialization,
+                    window,
+                    changed_from,
+                ),
+            )
+
+        query = text(
+            template.render(
+                sql=sql,
+                table_name=table_name,
+                metadata=metadata,
+                columns=columns,
+                full_refresh=full_refresh,
+                incremental_key=incremental_key,
+                incremental_key_type=columns.get(incremental_key, "TIMESTAMPTZ"),
+                lookback=metadata.get("lookback", "0 seconds"),
+                indexes=table_indexes(table_name, metadata),
+                sort_key=metadata.get("sort_key"),
+                window=window,
+                changed_from=changed_from,
+            )
         )
-        print("Clean up old logs in table")
         print(query)
+        db.execute(text(BUILD_METRICS_DDL))
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
         db.execute(query)
+        if materialization == "dimension":
+            extend_dimension(db, table_name, metadata)
+        elapsed = time.perf_counter() - start
+        # A windowed build of an incremental or stateful table only takes in
+        # the changes inside its window
+        if window is None or materialization in ("replace", "dimension"):
+            record_table_load(db, table_name, load_id)
+        bump_table_versions(db, [table_name])
+        record_run_metrics(
+            db, "create_table", table_name, started_at, elapsed, query_plan=query_plan
+        )
+    log_pool_stats()
 
-    DATA_FOLDER = os.getenv("DATA_FOLDER", ".")
-    files = os.listdir(DATA_FOLDER)
-    datafiles = [f"{DATA_FOLDER}/{filename}" for filename in files]
-    for datafile in datafiles:
-        print(f"Loading {datafile}")
-        load_datafile(datafile)
 
+def has_state(db, table_name):
+    """Whether the stateful `table_name` has a `_state_` table with any keys."""
+    exists = db.execute(
+        text("SELECT to_regclass(:table_name) IS NOT NULL"),
+        {"table_name": f"public._state_{table_name}"},
+    ).scalar()
+    return (
+        exists
+        and db.execute(
+            text(f"SELECT EXISTS (SELECT 1 FROM public._state_{table_name})")
+        ).scalar()
+    )
 
-def load_datafile(datafile, table_name="logs"):
-    with session_scope() as db:
-        query = text("CREATE TABLE IF NOT EXISTS logs (raw JSONB);")
+
+def extend_dimension(db, table_name, metadata):
+    """Parse the keys the `dimension` template found new into `table_name`.
+
+    The header's `parser` (a dotted path) takes a key and returns a namedtuple
+    of the other columns, so each key is only parsed once.
+    """
+    module, _, name = metadata["parser"].rpartition(".")
+    parser = getattr(importlib.import_module(module), name)
+    key, columns = metadata["key"], list(metadata["columns"])
+    keys = [value for value, in db.execute(text(f"SELECT key FROM _new_{table_name}"))]
+
+    cursor = db.connection().connection.cursor()
+    for chunk in iter_chunks(keys, COPY_CHUNK_ROWS):
+        lines = []
+        for value in chunk:
+            row = dict(parser(value)._asdict(), **{key: value})
+            lines.append(copy_line(row.get(column) for column in columns))
+        cursor.copy_expert(
+            f"COPY public.{table_name} ({', '.join(columns)}) FROM STDIN",
+            io.StringIO("".join(lines)),
+        )
+    print(f"Parsed {len(keys)} new keys into '{table_name}'.")
+
+
+def fan_out_tables(
+    table_names,
+    source="events",
+    source_key="date",
+    full_refresh=None,
+    explain=None,
+    window_start=None,
+    window_end=None,
+):
+    """Build several tables from a single read of `source`.
+
+    Each table's SQL selects its `log_type` (from the header) out of `source`;
+    a table with `log_type: "*"` gets every row no other table takes. Tables
+    that are rebuilt are swapped in together, incremental ones only have rows
+    from their high-water mark (or the earliest date changed by the loads since
+    their last build) onwards replaced, or only the rows of the window if given
+    one (see `create_table`). When every table is incremental only the rows of
+    `source` with `source_key` past the lowest of these (and before the
+    window's end) are read. Each table is recorded in `etl_run_metrics` with
+    the time of the whole statement and the rows routed to it, and the plan of
+    the statement if `explain` (or CAPTURE_QUERY_PLANS=1).
+    """
+    window = parse_window(window_start, window_end)
+    full_refresh = use_full_refresh(full_refresh) and window is None
+    tables = []
+    for table_name in table_names:
+        sql = read_sql(table_name)
+        metadata = parse_header(sql)
+        incremental_key = metadata.get("incremental_key")
+        tables.append(
+            {
+                "name": table_name,
+                "sql": sql,
+                "log_type": metadata["log_type"],
+                "columns": metadata["columns"],
+                "incremental": not full_refresh
+                and metadata.get("materialization") == "incremental",
+                "incremental_key": incremental_key,
+                "incremental_key_type": metadata["columns"].get(
+                    incremental_key, "TIMESTAMPTZ"
+                ),
+                "lookback": metadata.get("lookback", "0 seconds"),
+                "indexes": table_indexes(table_name, metadata),
+                "sort_key": metadata.get("sort_key"),
+            }
+        )
+    log_types = [table["log_type"] for table in tables if table["log_type"] != "*"]
+    if not all(table["incremental"] for table in tables):
+        source_key = None
+
+    template = read_template("fan_out")
+    with table_locks(table_names), session_scope() as db:
+        load_id = built_from_load(db, [source])
+        for table in tables:
+            table["changed_from"] = changed_since_load(
+                db, table["name"], load_id, source
+            )
+        context = {
+            "tables": tables,
+            "log_types": log_types,
+            "source": source,
+            "source_key": source_key,
+            "window": window,
+        }
+        query_plan = None
+        if use_query_plans(explain):
+            # EXPLAIN ANALYZE routes the rows for real, so its run is rolled
+            # back before the build
+            savepoint = db.begin_nested()
+            db.execute(text(BUILD_METRICS_DDL))
+            plan = db.execute(text(template.render(explain=True, **context)))
+            query_plan = "\n".join(line for line, in plan)
+            savepoint.rollback()
+
+        db.execute(text(BUILD_METRICS_DDL))
+        query = text(template.render(**context))
         print(query)
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
         db.execute(query)
+        elapsed = time.perf_counter() - start
+        if window is None:
+            for table_name in table_names:
+                record_table_load(db, table_name, load_id)
+        bump_table_versions(db, table_names)
+        for table_name in table_names:
+            record_run_metrics(
+                db,
+                "fan_out_tables",
+                table_name,
+                started_at,
+                elapsed,
+                query_plan=query_plan,
+            )
+    log_pool_stats()
 
-    values = []
-    with open(datafile) as f:
-        values = [row for row in f.readlines()]
-        values = [row.replace("'", "''") for row in values]  # escape single-quotes
-        values_str = "'),('".join(values)
-        insert_sql = f"INSERT INTO logs VALUES ('{values_str}');"
+
+# Each load that changed a raw table, with the range of event dates it added or
+# removed, and the last of those loads each built table holds the changes of
+LOADS_DDL = """
+    CREATE TABLE IF NOT EXISTS ingest_loads (
+        load_id BIGSERIAL PRIMARY KEY,
+        table_name TEXT NOT NULL,
+        path TEXT NOT NULL,
+        first_date TIMESTAMPTZ NOT NULL,
+        last_date TIMESTAMPTZ NOT NULL,
+        loaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS etl_table_loads (
+        table_name TEXT PRIMARY KEY,
+        load_id BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def built_from_load(db, table_names):
+    """The last load (`ingest_loads`) whose changes all of `table_names` hold:
+    the latest one for a raw table (eg. `events`), the one each other table
+    was last built from (0 if never)."""
+    db.execute(text(LOADS_DDL))
+    load_ids = []
+    for table_name in table_names:
+        if table_name == "events":
+            # Loads number themselves under this lock (see `load_datafile`), so
+            # none can commit with a lower load_id once it's read
+            db.execute(text("SELECT pg_advisory_lock_shared(hashtext('ingest_loads'))"))
+            load_id = db.execute(
+                text("SELECT MAX(load_id) FROM ingest_loads WHERE table_name = :name"),
+                {"name": table_name},
+            ).scalar()
+            db.execute(
+                text("SELECT pg_advisory_unlock_shared(hashtext('ingest_loads'))")
+            )
+        else:
+            load_id = db.execute(
+                text("SELECT load_id FROM etl_table_loads WHERE table_name = :name"),
+                {"name": table_name},
+            ).scalar()
+        load_ids.append(load_id or 0)
+    return min(load_ids, default=0)
+
+
+def changed_since_load(db, table_name, load_id, source="events"):
+    """The earliest event date changed by the loads into `source` up to
+    `load_id` that `table_name` wasn't built from yet, None if there are none.
+
+    Incremental builds go back to it, as their high-water mark alone misses
+    the rows of a new file for an earlier month, of a reloaded file and late
+    lines.
+    """
+    return db.execute(
+        text(
+            """
+            SELECT MIN(first_date)
+            FROM ingest_loads
+            WHERE table_name = :source
+                AND load_id <= :load_id
+                AND load_id > COALESCE(
+                    (SELECT load_id FROM etl_table_loads WHERE table_name = :name), 0
+                )
+            """
+        ),
+        {"name": table_name, "source": source, "load_id": load_id},
+    ).scalar()
+
+
+def record_table_load(db, table_name, load_id):
+    """Record that `table_name` holds the changes of the loads up to `load_id`."""
+    db.execute(
+        text(
+            """
+            INSERT INTO etl_table_loads (table_name, load_id)
+            VALUES (:table_name, :load_id)
+            ON CONFLICT (table_name) DO UPDATE SET
+                load_id = EXCLUDED.load_id,
+                updated_at = NOW();
+            """
+        ),
+        {"table_name": table_name, "load_id": load_id},
+    )
+
+
+def bump_table_versions(db, table_names):
+    """Record that `table_names` were rebuilt so cached query results expire."""
+    db.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS etl_table_versions (
+                table_name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+            """
+        )
+    )
+    for table_name in table_names:
+        db.execute(
+            text(
+                """
+                INSERT INTO etl_table_versions (table_name, version)
+                VALUES (:table_name, 1)
+                ON CONFLICT (table_name) DO UPDATE SET
+                    version = etl_table_versions.version + 1,
+                    updated_at = NOW();
+                """
+            ),
+            {"table_name": table_name},
+        )
+
+
+RUN_METRICS_DDL = """
+    CREATE TABLE IF NOT EXISTS etl_run_metrics (
+        id BIGSERIAL PRIMARY KEY,
+        task TEXT NOT NULL,
+        target TEXT NOT NULL,
+        started_at TIMESTAMPTZ NOT NULL,
+        seconds DOUBLE PRECISION NOT NULL,
+        rows BIGINT,
+        bytes BIGINT,
+        query_plan TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS etl_run_metrics_target_started_at_idx
+        ON etl_run_metrics (target, started_at);
+"""
+
+
+# The rows (and their bytes) each table's template wrote, for
+# `record_run_metrics`; a temporary table, so builds don't see each other's
+BUILD_METRICS_DDL = """
+    DROP TABLE IF EXISTS pg_temp._build_metrics;
+    CREATE TEMP TABLE _build_metrics (
+        target TEXT NOT NULL,
+        rows BIGINT NOT NULL,
+        bytes BIGINT
+    );
+"""
+
+
+def record_run_metrics(db, task, target, started_at, seconds, query_plan=None):
+    """Record a table build: its time, the rows and bytes it wrote (the whole
+    table when rebuilt, else the increment) and its plan."""
+    db.execute(text(RUN_METRICS_DDL))
+    rows = db.execute(
+        text(
+            """
+            INSERT INTO etl_run_metrics
+                (task, target, started_at, seconds, rows, bytes, query_plan)
+            SELECT
+                :task, :target, :started_at, :seconds,
+                SUM(rows), SUM(bytes), :query_plan
+            FROM _build_metrics
+            WHERE target = :target
+            RETURNING rows
+            """
+        ),
+        {
+            "task": task,
+            "target": target,
+            "started_at": started_at,
+            "seconds": seconds,
+            "query_plan": query_plan,
+        },
+    ).scalar()
+    print(f"Built '{target}' ({rows} rows) in {seconds:.2f}s.")
+
+
+def list_datafiles(data_folder=None):
+    """The log files of `data_folder` (default DATA_FOLDER), less hidden entries
+    (eg. the exploration cache) and folders."""
+    data_folder = data_folder or os.getenv("DATA_FOLDER", ".")
+    return [
+        f"{data_folder}/{filename}"
+        for filename in sorted(os.listdir(data_folder))
+        if not filename.startswith(".") and os.path.isfile(f"{data_folder}/{filename}")
+    ]
+
+
+def extract_log_data(
+    workers=LOAD_WORKERS, full_refresh=None, window_start=None, window_end=None
+):
+    """Append the data in DATA_FOLDER not yet in `events`, `workers` files at a time.
+
+    With `full_refresh` (or FULL_REFRESH=1) `events` and its manifest are rebuilt
+    from scratch instead. Given a window (see `parse_window`) only the files
+    that can have events in it are looked at (`window_datafiles`), and it is
+    never a full refresh.
+    """
+    window = parse_window(window_start, window_end)
+    full_refresh = use_full_refresh(full_refresh) and window is None
 
     with session_scope() as db:
-        query = text(insert_sql)
-        print(f"INSERTing {len(values)} rows into table '{table_name}'.")
-        db.execute(query)
+        db.execute(create_events_table("events"))
+
+    if full_refresh:
+        with session_scope() as db:
+            query = text(
+                """
+                TRUNCATE TABLE events;
+                DELETE FROM ingest_manifest WHERE table_name = 'events';
+                DELETE FROM ingest_rejects WHERE table_name = 'events';
+                """
+            )
+            print("Clean up old events in table")
+            print(query)
+            db.execute(query)
+
+    datafiles = list_datafiles()
+    if window:
+        datafiles = window_datafiles(datafiles, window)
+    print(f"Loading {len(datafiles)} files with {workers} workers")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(load_datafile, datafile): datafile for datafile in datafiles
+        }
+        rows = 0
+        for future in as_completed(futures):
+            rows += future.result()
+            print(f"Loaded {futures[future]}")
+
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {rows} new rows from {len(datafiles)} files in {elapsed:.2f}s.")
+    log_pool_stats()
+
+
+def window_datafiles(datafiles, window, table_name="events"):
+    """The `datafiles` that can have rows in `window`: every file but the ones
+    unchanged since they were loaded whose rows all fell outside of it."""
+    with session_scope() as db:
+        loaded = {
+            path: (size, first_date, last_date)
+            for path, size, first_date, last_date in db.execute(
+                text(
+                    """
+                    SELECT path, size, first_date, last_date
+                    FROM ingest_manifest
+                    WHERE table_name = :table_name
+                    """
+                ),
+                {"table_name": table_name},
+            )
+        }
+
+    selected = []
+    for datafile in datafiles:
+        size, first_date, last_date = loaded.get(datafile, (None, None, None))
+        outside = first_date is not None and (
+            last_date < window.start or first_date >= window.end
+        )
+        if not outside or os.path.getsize(datafile) != size:
+            selected.append(datafile)
+    return selected
+
+
+def create_events_table(table_name):
+    """The raw events table, partitioned by month, the ingest manifest, the
+    rejected lines, the log of loads and the run metrics (created up front, as
+    files are loaded in parallel).
+
+    The fields every log line has are typed columns; the rest of the line is
+    kept as `payload`. Concurrent callers create them one at a time, and once
+    they exist nothing here locks them: loaders hold locks on them while they
+    wait for `create_month_partitions` on another connection.
+    """
+    return text(
+        f"""
+        SELECT pg_advisory_xact_lock(hashtext('create:{table_name}'));
+
+        CREATE TABLE IF NOT EXISTS {table_name} ({EVENT_COLUMNS})
+        PARTITION BY RANGE (date);
+
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            table_name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size BIGINT NOT NULL,
+            checksum TEXT NOT NULL,
+            byte_offset BIGINT NOT NULL,
+            line_count BIGINT NOT NULL,
+            loaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            first_date TIMESTAMPTZ,
+            last_date TIMESTAMPTZ,
+            PRIMARY KEY (table_name, path)
+        );
+
+        CREATE TABLE IF NOT EXISTS ingest_rejects (
+            table_name TEXT NOT NULL,
+            source TEXT NOT NULL,
+            line_number BIGINT NOT NULL,
+            line TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            rejected_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        -- CREATE INDEX IF NOT EXISTS and ALTER TABLE lock the table even when
+        -- there's nothing to do, so the catalog is checked first
+        DO $$
+        BEGIN
+            IF to_regclass('{table_name}_log_type_date_idx') IS NULL THEN
+                CREATE INDEX {table_name}_log_type_date_idx
+                    ON {table_name} (log_type, date);
+            END IF;
+
+            IF to_regclass('ingest_rejects_source_idx') IS NULL THEN
+                CREATE INDEX ingest_rejects_source_idx
+                    ON ingest_rejects (table_name, source);
+            END IF;
+
+            -- For manifests from before the dates of each file were kept
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'ingest_manifest' AND column_name = 'first_date'
+            ) THEN
+                ALTER TABLE ingest_manifest
+                    ADD COLUMN first_date TIMESTAMPTZ,
+                    ADD COLUMN last_date TIMESTAMPTZ;
+            END IF;
+        END $$;
+        {LOADS_DDL}
+        {RUN_METRICS_DDL}
+        """
+    )
+
+
+def create_month_partitions(table_name, months):
+    """Create the monthly partitions of `table_name` covering `months` (UTC)."""
+    with session_scope() as db:
+        # Serialize loaders that discover the same new month
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:table_name))"),
+            {"table_name": table_name},
+        )
+        for month in sorted(months):
+            next_month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+            query = text(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table_name}_{month:%Y_%m}
+                PARTITION OF {table_name}
+                FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00')
+                    TO ('{next_month:%Y-%m-%d} 00:00+00');
+                """
+            )
+            db.execute(query)
+
+
+def file_checksum(datafile, offset):
+    """Fingerprint of the first `offset` bytes of `datafile`.
+
+    Only the head of the file and the block ending at `offset` are hashed, so
+    checking an appended file for rewrites doesn't re-read its whole history.
+    """
+    digest = hashlib.sha256(str(offset).encode())
+    with open(datafile, "rb") as f:
+        digest.update(f.read(min(offset, CHECKSUM_BYTES)))
+        f.seek(max(offset - CHECKSUM_BYTES, 0))
+        digest.update(f.read(min(offset, CHECKSUM_BYTES)))
+    return digest.hexdigest()
+
+
+def iter_chunks(rows, chunk_size):
+    """Group an iterable into lists of at most `chunk_size` items."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_lines(f, offset):
+    """Yield (end_offset, line) for each complete line of `f` after byte `offset`.
+
+    A trailing line without a newline is still being written, so it is left for
+    the next run.
+    """
+    f.seek(offset)
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        offset += len(line)
+        yield offset, line.rstrip(b"\r\n")
+
+
+def is_archive(datafile):
+    return datafile.endswith(ARCHIVE_EXTENSIONS)
+
+
+@contextmanager
+def open_archive(datafile):
+    """The decompressed contents of a .gz or .zst `datafile`, as a binary file."""
+    with open(datafile, "rb") as f:
+        if datafile.endswith(".gz"):
+            with gzip.GzipFile(fileobj=f) as archive:
+                yield archive
+        elif zstandard is None:
+            raise RuntimeError(f"zstandard is needed to load {datafile}")
+        else:
+            with zstandard.ZstdDecompressor().stream_reader(f) as archive:
+                yield archive
+
+
+def iter_blocks(datafile, block_size=DECOMPRESS_BLOCK_BYTES):
+    """Yield the decompressed blocks of a log archive.
+
+    Blocks are decompressed on their own thread (zlib and zstd release the GIL)
+    and queued up to DECOMPRESS_AHEAD blocks ahead, so decompressing overlaps
+    parsing and COPYing the previous blocks.
+    """
+    blocks = queue.Queue(maxsize=DECOMPRESS_AHEAD)
+    stopped = threading.Event()
+
+    def put(item):
+        """Queue `item` unless the reader stopped; False once it has."""
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress():
+        try:
+            with open_archive(datafile) as archive:
+                for block in iter(lambda: archive.read(block_size), b""):
+                    if not put(block):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=decompress, name=f"decompress {datafile}")
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def iter_archive_lines(datafile):
+    """Yield (end_offset, line) for each line of a log archive.
+
+    Offsets are into the decompressed data. Archives are complete, so a last
+    line without a newline is loaded too.
+    """
+    offset, rest = 0, b""
+    for block in iter_blocks(datafile):
+        lines = (rest + block).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            yield offset, line.rstrip(b"\r")
+    if rest:
+        yield offset + len(rest), rest.rstrip(b"\r")
+
+
+def read_lines(datafile, offset=0):
+    """Yield (end_offset, line) for the lines of `datafile` after byte `offset`,
+    plain files through `iter_lines` and archives (from the start) through
+    `iter_archive_lines`."""
+    if is_archive(datafile):
+        yield from iter_archive_lines(datafile)
+    else:
+        with open(datafile, "rb") as f:
+            yield from iter_lines(f, offset)
+
+
+def copy_escape(value):
+    """Escape a value for the COPY text format (backslash, tab and newlines)."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\r", "\\r")
+        .replace("\n", "\\n")
+    )
+
+
+def copy_line(values):
+    """A line of `values` in the COPY text format, None being NULL."""
+    values = ("\\N" if value is None else copy_escape(str(value)) for value in values)
+    return "\t".join(values) + "\n"
+
+
+def copy_event(event, source):
+    """The `parse_event` fields and `source` (already escaped) as a COPY line.
+
+    `parse_event` only lets printable text without backslashes through in the
+    text fields, and tabs and newlines only appear escaped in JSON, so only the
+    payload's backslashes need escaping.
+    """
+    date, log_type, account, level, payload = event
+    if "\\" in payload:
+        payload = payload.replace("\\", "\\\\")
+    return f"{date.isoformat()}\t{log_type}\t{account}\t{level}\t{payload}\t{source}\n"
+
+
+def parse_pool():
+    """The process pool shared by every loader thread, started on first use."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+        return _parse_pool
+
+
+ParsedChunk = namedtuple("ParsedChunk", "events rejects rows rejected months")
+
+
+def parse_chunk(lines, datafile, reject_table, line_number):
+    """Validate and type `lines` (the first being line `line_number` + 1) of
+    `datafile` into COPY text for `events` and for `ingest_rejects`.
+
+    Runs in a `parse_pool` process.
+    """
+    source = copy_escape(datafile)
+    events, rejects, months = [], [], set()
+    for number, line in enumerate(lines, start=line_number + 1):
+        if not line.strip():
+            continue
+        try:
+            event = parse_event(line)
+        except RejectedLine as e:
+            line = line.decode("utf-8", "replace").replace("\x00", "")
+            rejects.append(copy_line((reject_table, datafile, number, line, e)))
+            continue
+        events.append(copy_event(event, source))
+        months.add((event[0].year, event[0].month))
+    return ParsedChunk(
+        "".join(events), "".join(rejects), len(events), len(rejects), months
+    )
+
+
+CopyResult = namedtuple("CopyResult", "rows lines rejected months end_offset")
+
+
+def copy_datafile(
+    cursor,
+    datafile,
+    table_name,
+    offset=0,
+    line_number=0,
+    reject_table="events",
+    chunk_rows=COPY_CHUNK_ROWS,
+    rejects_table="ingest_rejects",
+):
+    """COPY the lines of `datafile` after byte `offset` (line `line_number`) into
+    `table_name`, typed as the columns of `events`.
+
+    Chunks of lines are parsed in `parse_pool` while earlier ones are COPYed.
+    Lines that fail `parse_event` go to `rejects_table` (a table like
+    `ingest_rejects`, under `reject_table`) with their line number and the
+    reason instead. Returns the rows loaded, the
+    lines read, the lines rejected, the UTC months of the rows and the byte
+    offset after the last line.
+    """
+    result = {"rows": 0, "rejected": 0, "months": set()}
+
+    def copy_parsed(parsed):
+        columns = "date, log_type, account, level, payload, source"
+        cursor.copy_expert(
+            f"COPY {table_name} ({columns}) FROM STDIN", io.StringIO(parsed.events)
+        )
+        if parsed.rejects:
+            columns = "table_name, source, line_number, line, reason"
+            cursor.copy_expert(
+                f"COPY {rejects_table} ({columns}) FROM STDIN",
+                io.StringIO(parsed.rejects),
+            )
+        result["rows"] += parsed.rows
+        result["rejected"] += parsed.rejected
+        result["months"] |= parsed.months
+
+    lines, pending = 0, deque()
+    for chunk in iter_chunks(read_lines(datafile, offset), chunk_rows):
+        offset = chunk[-1][0]
+        pending.append(
+            parse_pool().submit(
+                parse_chunk,
+                [line for _, line in chunk],
+                datafile,
+                reject_table,
+                line_number + lines,
+            )
+        )
+        lines += len(chunk)
+        # Keep only a few chunks in memory
+        if len(pending) > PARSE_WORKERS:
+            copy_parsed(pending.popleft().result())
+    while pending:
+        copy_parsed(pending.popleft().result())
+
+    months = {date(year, month, 1) for year, month in result["months"]}
+    return CopyResult(result["rows"], lines, result["rejected"], months, offset)
+
+
+def load_datafile(datafile, table_name="events", chunk_rows=COPY_CHUNK_ROWS):
+    """Stream the part of `datafile` not yet in `ingest_manifest` into `table_name`.
+
+    New files are loaded whole and files seen before only from their last
+    loaded byte; a file that was truncated or rewritten is reloaded. Log
+    archives (.gz, .zst) are decompressed as they stream in and, as they are
+    never appended to, loaded whole. Lines are validated and typed (see
+    `parse_event`), COPYed into temporary tables and moved into the monthly
+    partitions from there once they exist; lines that fail go to
+    `ingest_rejects`. Nothing but temporary tables is locked until then, as the
+    partitions are created on another connection. The rows,
+    the rejects, the manifest entry (with the first and last date of the file's
+    rows, see `window_datafiles`), the dates the load added or removed (in
+    `ingest_loads`, see `changed_since_load`) and the load's `etl_run_metrics`
+    row are committed together. Loads of the same file wait for each other. Returns
+    the number of rows loaded.
+
+    Expects `table_name` and the manifest to exist (see `create_events_table`).
+    """
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    size = os.path.getsize(datafile)
+    archive = is_archive(datafile)
+    staging_table = f"_load_{table_name}"
+    rejects_table = f"_load_{table_name}_rejects"
+    manifest_query = """
+        SELECT checksum, byte_offset, line_count, first_date, last_date
+        FROM ingest_manifest
+        WHERE table_name = %s AND path = %s
+    """
+    with raw_connection_scope() as connection:
+        cursor = connection.cursor()
+        # A new file has no manifest row to lock yet
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(hashtext(%s))",
+            (f"load:{table_name}:{datafile}",),
+        )
+        cursor.execute(manifest_query, (table_name, datafile))
+        manifest = cursor.fetchone() or (None, 0, 0, None, None)
+        checksum, offset, line_count, old_first_date, old_last_date = manifest
+        reload = bool(checksum) and (
+            size < offset or file_checksum(datafile, offset) != checksum
+        )
+        # Archives can't be appended to, so a bigger one was replaced
+        reload = reload or (bool(checksum) and archive and size != offset)
+        if reload:
+            print(f"{datafile} changed since it was loaded; reloading it")
+            offset, line_count = 0, 0
+        elif checksum and size == offset:
+            print(f"{datafile} has no new data")
+            return 0
+
+        cursor.execute(
+            f"""
+            CREATE TEMP TABLE {staging_table} ({EVENT_COLUMNS}) ON COMMIT DROP;
+            CREATE TEMP TABLE {rejects_table} (LIKE ingest_rejects INCLUDING DEFAULTS)
+            ON COMMIT DROP;
+            """
+        )
+        result = copy_datafile(
+            cursor,
+            datafile,
+            staging_table,
+            offset,
+            line_count,
+            reject_table=table_name,
+            chunk_rows=chunk_rows,
+            rejects_table=rejects_table,
+        )
+        # The manifest tracks archives by their compressed size
+        rows, end_offset = result.rows, size if archive else result.end_offset
+        # Partitions are created on their own connection, which waits for every
+        # transaction using `table_name`, so this one mustn't hold any lock it
+        # (or a loader it waits for) needs until they exist
+        create_month_partitions(table_name, result.months)
+
+        cursor.execute(manifest_query + " FOR UPDATE", (table_name, datafile))
+        if (cursor.fetchone() or (None, 0))[:2] != manifest[:2]:
+            raise RuntimeError(f"The manifest of {datafile} changed while loading it")
+        if reload:
+            cursor.execute(
+                "DELETE FROM ingest_rejects WHERE table_name = %s AND source = %s",
+                (table_name, datafile),
+            )
+            cursor.execute(
+                """
+                UPDATE ingest_manifest SET first_date = NULL, last_date = NULL
+                WHERE table_name = %s AND path = %s
+                """,
+                (table_name, datafile),
+            )
+            cursor.execute(f"DELETE FROM {table_name} WHERE source = %s", (datafile,))
+        cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {staging_table}")
+        cursor.execute(f"INSERT INTO ingest_rejects SELECT * FROM {rejects_table}")
+        cursor.execute(f"SELECT MIN(date), MAX(date) FROM {staging_table}")
+        first_date, last_date = cursor.fetchone()
+        cursor.execute(
+            """
+            INSERT INTO ingest_manifest (
+                table_name, path, size, checksum, byte_offset, line_count,
+                first_date, last_date
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name, path) DO UPDATE SET
+                size = EXCLUDED.size,
+                checksum = EXCLUDED.checksum,
+                byte_offset = EXCLUDED.byte_offset,
+                line_count = EXCLUDED.line_count,
+                loaded_at = NOW(),
+                first_date = LEAST(ingest_manifest.first_date, EXCLUDED.first_date),
+                last_date = GREATEST(ingest_manifest.last_date, EXCLUDED.last_date)
+            """,
+            (
+                table_name,
+                datafile,
+                size,
+                file_checksum(datafile, end_offset),
+                end_offset,
+                line_count + result.lines,
+                first_date,
+                last_date,
+            ),
+        )
+        cursor.execute(
+            """
+            INSERT INTO etl_run_metrics (task, target, started_at, seconds, rows, bytes)
+            VALUES ('load_datafile', %s, %s, %s, %s, %s)
+            """,
+            (
+                datafile,
+                started_at,
+                time.perf_counter() - start,
+                rows,
+                end_offset - offset,
+            ),
+        )
+        # A reload also removed the rows the file had before
+        changed = [first_date, last_date]
+        if reload:
+            changed += [old_first_date, old_last_date]
+        changed = [d for d in changed if d is not None]
+        if changed:
+            # Held until the commit, so loads commit in load_id order (see
+            # `built_from_load`)
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('ingest_loads'))")
+            cursor.execute(
+                """
+                INSERT INTO ingest_loads (table_name, path, first_date, last_date)
+                VALUES (%s, %s, %s, %s)
+                """,
+                (table_name, datafile, min(changed), max(changed)),
+            )
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Loaded {rows} rows from byte {offset} of {datafile} into table "
+        f"'{table_name}' in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)."
+    )
+    if result.rejected:
+        print(f"Rejected {result.rejected} lines of {datafile}, see ingest_rejects.")
+    return rows
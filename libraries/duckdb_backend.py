@@ -0,0 +1,268 @@
+"""
+Run the etl/sql models in-process on DuckDB, without Postgres or Airflow.
+
+The log files of DATA_FOLDER (plain or archived) are validated by the same
+`parse_event` as `load_datafile` and loaded into `events` in DUCKDB_PATH, the
+rejected lines going to `ingest_rejects`. Every table of etl/sql is then built
+in dependency order, always whole: incremental and stateful tables run their
+query, which is the table's full definition, and `dimension` tables parse all
+their keys with their `parser`. The models are written for Postgres, so they go
+through `duckdb_sql` first. It can be run from the root folder via:
+    `venv/bin/python -m libraries.duckdb_backend`
+"""
+
+import argparse
+import importlib
+import os
+import re
+import time
+
+from collections import deque
+
+import duckdb
+import pyarrow as pa
+
+from libraries.database import (
+    COPY_CHUNK_ROWS,
+    EVENT_COLUMNS,
+    PARSE_WORKERS,
+    PROJECT_ROOT,
+    build_order,
+    iter_chunks,
+    list_datafiles,
+    parse_header,
+    parse_pool,
+    read_lines,
+    read_sql,
+    table_dependencies,
+)
+from libraries.log_parser import RejectedLine, parse_event
+
+DUCKDB_PATH = os.getenv("DUCKDB_PATH", f"{PROJECT_ROOT}/local.duckdb")
+
+# Postgres types of the SQL headers and EVENT_COLUMNS that DuckDB names
+# otherwise; DuckDB's NUMERIC keeps 3 decimals, where Postgres keeps them all
+DUCKDB_TYPES = {"JSONB": "JSON", "NUMERIC": "DOUBLE"}
+
+# The `parse_event` fields and the source file, as loaded into `events`
+EVENT_SCHEMA = pa.schema(
+    [
+        ("date", pa.timestamp("us", tz="UTC")),
+        ("log_type", pa.string()),
+        ("account", pa.string()),
+        ("level", pa.string()),
+        ("payload", pa.string()),
+        ("source", pa.string()),
+    ]
+)
+
+INGEST_REJECTS_DDL = """
+    CREATE OR REPLACE TABLE ingest_rejects (
+        table_name TEXT NOT NULL,
+        source TEXT NOT NULL,
+        line_number BIGINT NOT NULL,
+        line TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        rejected_at TIMESTAMPTZ NOT NULL DEFAULT current_timestamp
+    )
+"""
+
+
+def duckdb_sql(sql):
+    """`sql` written for Postgres, as DuckDB runs it.
+
+    Types are renamed (DUCKDB_TYPES) and time zones upper cased to their ICU
+    names (`AT TIME ZONE 'est'`). The rest of what the models use (`->>`,
+    `::`, SPLIT_PART, DATE_TRUNC, window functions, ...) reads the same.
+    """
+    sql = re.sub(
+        rf"\b({'|'.join(DUCKDB_TYPES)})\b",
+        lambda match: DUCKDB_TYPES[match.group(1).upper()],
+        sql,
+        flags=re.I,
+    )
+    return re.sub(
+        r"(AT\s+TIME\s+ZONE\s+)'([^']*)'",
+        lambda match: f"{match.group(1)}'{match.group(2).upper()}'",
+        sql,
+        flags=re.I,
+    )
+
+
+def connect(path=DUCKDB_PATH):
+    connection = duckdb.connect(path)
+    # Timestamps are read and truncated in UTC, as on the warehouse
+    connection.execute("SET TimeZone = 'UTC'")
+    return connection
+
+
+def parse_lines(lines, datafile, line_number):
+    """Validate and type `lines` (the first being line `line_number` + 1) of
+    `datafile` into the columns of `parse_event`, and the rejected lines.
+
+    Runs in a `parse_pool` process.
+    """
+    columns, rejects = [[], [], [], [], []], []
+    for number, line in enumerate(lines, start=line_number + 1):
+        if not line.strip():
+            continue
+        try:
+            event = parse_event(line)
+        except RejectedLine as e:
+            line = line.decode("utf-8", "replace").replace("\x00", "")
+            rejects.append(("events", datafile, number, line, str(e)))
+            continue
+        for column, value in zip(columns, event):
+            column.append(value)
+    return columns, rejects
+
+
+def insert_parsed(connection, parsed, datafile):
+    """Append the result of `parse_lines` to `events` and `ingest_rejects`."""
+    columns, rejects = parsed
+    rows = len(columns[0])
+    if rows:
+        arrays = [
+            pa.array(values, type=field.type)
+            for values, field in zip(columns + [[datafile] * rows], EVENT_SCHEMA)
+        ]
+        batch = pa.Table.from_arrays(arrays, schema=EVENT_SCHEMA)
+        connection.register("_events_batch", batch)
+        connection.execute("INSERT INTO events SELECT * FROM _events_batch")
+        connection.unregister("_events_batch")
+    if rejects:
+        connection.executemany(
+            """
+            INSERT INTO ingest_rejects (table_name, source, line_number, line, reason)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            rejects,
+        )
+    return rows, len(rejects)
+
+
+def load_events(connection, datafiles, chunk_rows=COPY_CHUNK_ROWS):
+    """Replace `events` and `ingest_rejects` with the lines of `datafiles`.
+
+    Chunks of lines are parsed in `parse_pool` while earlier ones are inserted.
+    Returns the rows loaded.
+    """
+    connection.execute(duckdb_sql(f"CREATE OR REPLACE TABLE events ({EVENT_COLUMNS})"))
+    connection.execute(INGEST_REJECTS_DDL)
+
+    start = time.perf_counter()
+    totals = {"rows": 0, "rejected": 0}
+
+    def insert_next(pending, datafile):
+        rows, rejected = insert_parsed(connection, pending.popleft().result(), datafile)
+        totals["rows"] += rows
+        totals["rejected"] += rejected
+
+    for datafile in datafiles:
+        lines, pending = 0, deque()
+        for chunk in iter_chunks(read_lines(datafile), chunk_rows):
+            pending.append(
+                parse_pool().submit(
+                    parse_lines, [line for _, line in chunk], datafile, lines
+                )
+            )
+            lines += len(chunk)
+            # Keep only a few chunks in memory
+            if len(pending) > PARSE_WORKERS:
+                insert_next(pending, datafile)
+        while pending:
+            insert_next(pending, datafile)
+
+    elapsed = time.perf_counter() - start
+    rows = totals["rows"]
+    print(f"Loaded {rows} rows from {len(datafiles)} files in {elapsed:.2f}s.")
+    if totals["rejected"]:
+        print(f"Rejected {totals['rejected']} lines, see ingest_rejects.")
+    return rows
+
+
+def build_dimension(connection, table_name, sql, metadata):
+    """Parse every key of `sql` into `table_name` (see `extend_dimension`)."""
+    module, _, name = metadata["parser"].rpartition(".")
+    parser = getattr(importlib.import_module(module), name)
+    key, columns = metadata["key"], metadata["columns"]
+    keys = connection.execute(
+        duckdb_sql(
+            f"SELECT DISTINCT {key} FROM (\n{sql}\n) AS query WHERE {key} IS NOT NULL"
+        )
+    ).fetchall()
+
+    definitions = ", ".join(f"{column} {t}" for column, t in columns.items())
+    connection.execute(
+        duckdb_sql(f"CREATE OR REPLACE TABLE {table_name} ({definitions})")
+    )
+    if keys:
+        rows = [dict(parser(value)._asdict(), **{key: value}) for value, in keys]
+        arrays = [pa.array([row.get(column) for row in rows]) for column in columns]
+        connection.register(
+            "_dimension_batch", pa.Table.from_arrays(arrays, names=list(columns))
+        )
+        connection.execute(f"INSERT INTO {table_name} SELECT * FROM _dimension_batch")
+        connection.unregister("_dimension_batch")
+
+
+def build_table(connection, table_name, other_log_types=()):
+    """Build `table_name` whole from its query, as a full refresh would.
+
+    The bronze table with `log_type: "*"` gets the rows of every log_type but
+    `other_log_types`, as in `fan_out_tables`.
+    """
+    start = time.perf_counter()
+    sql = read_sql(table_name)
+    metadata = parse_header(sql)
+    if metadata.get("materialization") == "dimension":
+        build_dimension(connection, table_name, sql, metadata)
+    else:
+        query = f"SELECT * FROM (\n{sql}\n) AS query"
+        if metadata.get("log_type") == "*" and other_log_types:
+            log_types = "', '".join(other_log_types)
+            query += f"\nWHERE log_type NOT IN ('{log_types}')"
+        if metadata.get("sort_key"):
+            query += f"\nORDER BY {metadata['sort_key']}"
+        connection.execute(
+            duckdb_sql(f"CREATE OR REPLACE TABLE {table_name} AS {query}")
+        )
+
+    rows = connection.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    elapsed = time.perf_counter() - start
+    print(f"Built '{table_name}' ({rows} rows) in {elapsed:.2f}s.")
+
+
+def run_local(data_folder=None, path=DUCKDB_PATH):
+    """Load `data_folder` (default DATA_FOLDER) and build every table into the
+    DuckDB database at `path`."""
+    start = time.perf_counter()
+    connection = connect(path)
+    try:
+        load_events(connection, list_datafiles(data_folder))
+        order = build_order(table_dependencies())
+        log_types = [
+            log_type
+            for log_type in (parse_header(read_sql(t)).get("log_type") for t in order)
+            if log_type and log_type != "*"
+        ]
+        for table_name in order:
+            build_table(connection, table_name, log_types)
+    finally:
+        connection.close()
+    elapsed = time.perf_counter() - start
+    print(f"Built {len(order)} tables into {path} in {elapsed:.2f}s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--data", default=None, help="Defaults to DATA_FOLDER")
+    parser.add_argument(
+        "--database", default=DUCKDB_PATH, help="Defaults to DUCKDB_PATH"
+    )
+    args = parser.parse_args()
+    run_local(args.data, args.database)
+
+
+if __name__ == "__main__":
+    main()
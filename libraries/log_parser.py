@@ -0,0 +1,106 @@
+"""Validate log lines and split them into the typed columns of `events`."""
+
+from datetime import datetime, timezone
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(value):
+        return orjson.dumps(value).decode("utf-8")
+
+
+except ImportError:  # orjson is only faster
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+# Fields every log line needs, then the ones each log_type needs on top
+REQUIRED_FIELDS = ("date", "log_type", "level", "account")
+LOG_TYPE_FIELDS = {
+    log_type: REQUIRED_FIELDS + fields
+    for log_type, fields in {
+        "SIGN_UP": ("plan", "address"),
+        "LOGIN": ("details",),
+        "PAGE_ACCESS": ("details",),
+        "UPLOAD": ("details",),
+        "PLAN_CHANGE": ("details",),
+    }.items()
+}
+PLAN_CHANGE_FIELDS = ("change_date", "from", "to")
+
+
+class RejectedLine(ValueError):
+    """A log line that can't be loaded; the message is the reason."""
+
+
+def parse_timestamp(value):
+    """The UTC datetime of an ISO 8601 date with a UTC offset."""
+    if not isinstance(value, str):
+        raise RejectedLine(f"date {value!r} is not a string")
+    try:
+        # fromisoformat only takes "Z" from Python 3.11
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise RejectedLine(f"date {value!r} is not ISO 8601")
+    if date.tzinfo is None:
+        raise RejectedLine(f"date {value!r} has no UTC offset")
+    return date.astimezone(timezone.utc)
+
+
+def check_fields(values, fields, prefix="missing"):
+    """Raise `RejectedLine` naming the `fields` that are missing or empty."""
+    for field in fields:
+        if values.get(field) is None or values[field] == "":
+            missing = [f for f in fields if values.get(f) in (None, "")]
+            raise RejectedLine(f"{prefix} {', '.join(missing)}")
+
+
+def parse_event(line):
+    """Validate a log line and return its (date, log_type, account, level, payload).
+
+    The date is in UTC and the payload is the JSON of the other fields. Raises
+    `RejectedLine` when the line is not JSON, misses a field its log_type
+    needs, or has a malformed date.
+    """
+    try:
+        event = json_loads(line)
+    except ValueError as e:
+        raise RejectedLine(f"invalid JSON: {e}")
+    if not isinstance(event, dict):
+        raise RejectedLine("not a JSON object")
+
+    log_type = event.get("log_type")
+    fields = LOG_TYPE_FIELDS.get(str(log_type), REQUIRED_FIELDS)
+    check_fields(event, fields)
+
+    date = parse_timestamp(event.pop("date"))
+    log_type, level = event.pop("log_type"), event.pop("level")
+    account = event.pop("account")
+    if not isinstance(log_type, str) or not isinstance(level, str):
+        raise RejectedLine("log_type and level must be strings")
+    if isinstance(account, bool) or not isinstance(account, (int, str)):
+        raise RejectedLine(f"account {account!r} is not an id")
+    account = str(account)
+    text_fields = f"{log_type}{level}{account}"
+    if not text_fields.isprintable() or "\\" in text_fields:
+        raise RejectedLine("log_type, level and account must be printable text")
+
+    if log_type == "PLAN_CHANGE":
+        details = event["details"]
+        if not isinstance(details, dict):
+            raise RejectedLine("PLAN_CHANGE details is not an object")
+        check_fields(details, PLAN_CHANGE_FIELDS, prefix="missing details")
+        details["change_date"] = parse_timestamp(details["change_date"]).isoformat()
+
+    payload = json_dumps(event)
+    if "\\u0000" in payload:
+        raise RejectedLine("NUL characters can't be stored in JSONB")
+    return date, log_type, account, level, payload
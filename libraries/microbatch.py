@@ -0,0 +1,181 @@
+"""
+Near-real-time mode: tail DATA_FOLDER and push new log lines through to the
+dashboard's tables in micro-batches.
+
+Each batch loads the files that are new or were appended to since the last
+poll (`load_datafile`, which picks up from the last loaded byte), routes the
+new events into the bronze tables (`fan_out_tables`) and rebuilds
+MICROBATCH_TABLES and the tables they are built from (by default
+`churn_event`, `address_dim`, `user_location` and `province_by_year`). Every
+step is incremental, so a batch only touches the rows past each table's
+high-water mark, or from the earliest event its files changed.
+
+After each batch the event-to-dashboard latency (from when the batch's newest
+lines landed in their file to when the tables were committed) is recorded in
+`etl_run_metrics` as task `microbatch`. Its builds wait for the DAG's builds of
+the same tables (see `table_locks`). It can be run from the root folder via:
+    `venv/bin/python -m libraries.microbatch`
+"""
+
+import argparse
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from libraries.database import (
+    LOAD_WORKERS,
+    build_order,
+    create_events_table,
+    create_table,
+    fan_out_tables,
+    list_datafiles,
+    load_datafile,
+    read_table_metadata,
+    session_scope,
+    table_dependencies,
+)
+
+# Seconds from a line landing in DATA_FOLDER to it being in the tables; the
+# folder is polled every quarter of it, leaving the rest for the batch to run
+MICROBATCH_LATENCY = float(os.getenv("MICROBATCH_LATENCY", "10"))
+# Tables kept up to date, along with every table they are built from
+MICROBATCH_TABLES = os.getenv("MICROBATCH_TABLES", "province_by_year").split(",")
+
+
+def batch_tables(targets):
+    """The bronze tables, and `targets` and the other tables they are built from
+    (in build order), as the micro-batches build them."""
+    dependencies = table_dependencies()
+    needed, pending = set(), list(targets)
+    while pending:
+        table_name = pending.pop()
+        if table_name in dependencies and table_name not in needed:
+            needed.add(table_name)
+            pending.extend(dependencies[table_name])
+
+    tables = build_order(dependencies)
+    bronze = [t for t in tables if "log_type" in read_table_metadata(t)]
+    return bronze, [t for t in tables if t in needed and t not in bronze]
+
+
+class FolderWatcher:
+    """Finds the files of a folder that are new or changed since the last poll."""
+
+    def __init__(self, data_folder=None):
+        self.data_folder = data_folder
+        self.seen = {}
+
+    def poll(self):
+        """The changed files, with the time (epoch seconds) they last changed."""
+        changed = {}
+        for datafile in list_datafiles(self.data_folder):
+            try:
+                stat = os.stat(datafile)
+            except FileNotFoundError:  # removed since it was listed
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.seen.get(datafile) != signature:
+                self.seen[datafile] = signature
+                changed[datafile] = stat.st_mtime
+        return changed
+
+
+def record_latency(started_at, seconds, rows):
+    with session_scope() as db:
+        db.execute(
+            text(
+                """
+                INSERT INTO etl_run_metrics (task, target, started_at, seconds, rows)
+                VALUES ('microbatch', 'latency', :started_at, :seconds, :rows)
+                """
+            ),
+            {"started_at": started_at, "seconds": seconds, "rows": rows},
+        )
+
+
+def run_batch(changed, bronze_tables, tables, since, export=False):
+    """Load the `changed` files and rebuild the tables if they had new rows.
+
+    Lines already there at `since` (epoch seconds) count as landing then.
+    Returns the rows loaded and the latency, None if nothing was loaded.
+    """
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        rows = sum(pool.map(load_datafile, changed))
+    if not rows:
+        return 0, None
+
+    fan_out_tables(bronze_tables, full_refresh=False)
+    for table_name in tables:
+        create_table(table_name, full_refresh=False)
+    if export:
+        # Imported here as only the snapshot read mode needs pyarrow
+        from libraries.snapshots import export_snapshot
+
+        export_snapshot()
+
+    landed_at = max(max(changed.values()), since)
+    latency = time.time() - landed_at
+    record_latency(datetime.fromtimestamp(landed_at, timezone.utc), latency, rows)
+    return rows, latency
+
+
+def run(data_folder=None, targets=None, latency=MICROBATCH_LATENCY, export=False):
+    """Poll `data_folder` and run a batch whenever a file changes, until stopped."""
+    data_folder = data_folder or os.getenv("DATA_FOLDER", ".")
+    bronze_tables, tables = batch_tables(targets or MICROBATCH_TABLES)
+    with session_scope() as db:
+        db.execute(create_events_table("events"))
+
+    print(f"Keeping {', '.join(tables)} within {latency:.1f}s of {data_folder}")
+    watcher = FolderWatcher(data_folder)
+    since = time.time()
+    while True:
+        polled_at = time.time()
+        changed = watcher.poll()
+        if changed:
+            rows, batch_latency = run_batch(
+                changed, bronze_tables, tables, since, export=export
+            )
+            if batch_latency is not None:
+                over = " (over target)" if batch_latency > latency else ""
+                print(
+                    f"Loaded {rows} rows from {len(changed)} files; "
+                    f"event-to-dashboard latency {batch_latency:.2f}s{over}"
+                )
+        since = polled_at
+        time.sleep(max(latency / 4 - (time.time() - polled_at), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--data", default=None, help="Defaults to DATA_FOLDER")
+    parser.add_argument(
+        "--tables",
+        default=None,
+        help="Comma separated tables to keep up to date (MICROBATCH_TABLES)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=MICROBATCH_LATENCY,
+        help="Target seconds from a line landing to it being in the tables",
+    )
+    parser.add_argument(
+        "--export-snapshot",
+        action="store_true",
+        help="Export an Arrow snapshot after each batch, for DASH_READ_MODE=snapshot",
+    )
+    args = parser.parse_args()
+    targets = args.tables.split(",") if args.tables else None
+    try:
+        run(args.data, targets, args.latency, export=args.export_snapshot)
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Cache of query results for the dashboard.
+
+Results are keyed on the query text, its parameters and the ETL version (which
+every `create_table` bumps), so a rebuilt table expires every cached result.
+Entries live in an in-process LRU and, when QUERY_CACHE_DIR is set, in a
+directory shared by every dashboard worker.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from sqlalchemy import text
+
+from libraries.database import session_scope
+
+QUERY_CACHE_ENTRIES = int(os.getenv("QUERY_CACHE_ENTRIES", "256"))
+QUERY_CACHE_BYTES = int(os.getenv("QUERY_CACHE_BYTES", str(64 * 2 ** 20)))
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR")
+
+# Seconds a looked up ETL version is trusted before asking the database again
+ETL_VERSION_TTL = float(os.getenv("ETL_VERSION_TTL", "5"))
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by both entry count and total size in bytes."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiskCache:
+    """Pickled results in a directory; files of older ETL versions are removed."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, version, key):
+        return f"{self.folder}/{version}-{key}.pickle"
+
+    def get(self, version, key):
+        try:
+            with open(self.path(version, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, version, key, payload):
+        # Write then rename so other workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path(version, key))
+
+    def prune(self, version):
+        for filename in os.listdir(self.folder):
+            if filename.endswith(".pickle") and not filename.startswith(f"{version}-"):
+                try:
+                    os.remove(f"{self.folder}/{filename}")
+                except FileNotFoundError:
+                    pass  # pruned by another worker
+
+
+memory_cache = LRUCache(QUERY_CACHE_ENTRIES, QUERY_CACHE_BYTES)
+disk_cache = DiskCache(QUERY_CACHE_DIR) if QUERY_CACHE_DIR else None
+
+_version = {"value": None, "checked_at": 0.0}
+_version_lock = threading.Lock()
+
+
+def etl_version():
+    """The sum of all table versions; it grows whenever any table is rebuilt."""
+    with _version_lock:
+        if time.monotonic() - _version["checked_at"] < ETL_VERSION_TTL:
+            return _version["value"]
+
+    with session_scope() as transaction:
+        query = text("SELECT COALESCE(SUM(version), 0) FROM etl_table_versions")
+        version = int(transaction.execute(query).scalar())
+
+    with _version_lock:
+        if version != _version["value"]:
+            memory_cache.clear()
+            if disk_cache:
+                disk_cache.prune(version)
+        _version["value"] = version
+        _version["checked_at"] = time.monotonic()
+    return version
+
+
+def cached_query(query, params=None):
+    """Run `query` (text or a `text()` clause) and return its rows as tuples.
+
+    Results are served from the cache until the next ETL table build.
+    """
+    query = query if hasattr(query, "text") else text(query)
+    params = params or {}
+    version = etl_version()
+    key = hashlib.sha256(
+        repr((version, query.text, sorted(params.items()))).encode()
+    ).hexdigest()
+
+    results = memory_cache.get(key)
+    if results is not None:
+        return results
+
+    payload = disk_cache.get(version, key) if disk_cache else None
+    if payload is None:
+        with session_scope() as transaction:
+            results = [tuple(row) for row in transaction.execute(query, params)]
+        payload = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        if disk_cache:
+            disk_cache.put(version, key, payload)
+    else:
+        results = pickle.loads(payload)
+
+    memory_cache.put(key, results, len(payload))
+    return results
@@ -0,0 +1,269 @@
+"""
+Arrow snapshots of the tables the dashboard reads.
+
+The last task of the DAG (`export_snapshot`) writes every gold table, and any
+other table with `snapshot: true` in its header, to Arrow IPC files in a new
+folder of SNAPSHOT_DIR, then points `SNAPSHOT_DIR/LATEST` at it. In its
+snapshot read mode the dashboard memory-maps the latest snapshot's files
+instead of querying the warehouse, so it can scale out without adding load to
+Postgres.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from sqlalchemy import text
+
+from libraries.database import (
+    PROJECT_ROOT,
+    checkout,
+    list_tables,
+    log_pool_stats,
+    read_table_metadata,
+    stream_query,
+    table_locks,
+)
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", f"{PROJECT_ROOT}/snapshots")
+# Snapshots kept besides the latest, for dashboard workers still reading them
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))
+# Seconds a reader trusts its snapshot before checking for a newer one
+SNAPSHOT_TTL = float(os.getenv("SNAPSHOT_TTL", "5"))
+
+# Arrow type of each column type used in the SQL headers, and how to convert
+# the value psycopg2 returns for it
+ARROW_TYPES = {
+    "TEXT": pa.string(),
+    "JSONB": pa.string(),
+    "INTEGER": pa.int32(),
+    "BIGINT": pa.int64(),
+    "NUMERIC": pa.float64(),
+    "DOUBLE PRECISION": pa.float64(),
+    "BOOLEAN": pa.bool_(),
+    "DATE": pa.date32(),
+    "TIMESTAMP": pa.timestamp("us"),
+    "TIMESTAMPTZ": pa.timestamp("us", tz="UTC"),
+}
+CONVERTERS = {
+    "JSONB": json.dumps,
+    "NUMERIC": float,
+    # Older pyarrow ignores tzinfo, so hand it UTC wall times
+    "TIMESTAMPTZ": lambda value: value.astimezone(timezone.utc).replace(tzinfo=None),
+}
+
+OPERATORS = {
+    "=": pc.equal,
+    "<>": pc.not_equal,
+    "<": pc.less,
+    "<=": pc.less_equal,
+    ">": pc.greater,
+    ">=": pc.greater_equal,
+}
+
+
+def snapshot_tables():
+    """The gold tables, and the others with `snapshot: true` in their header."""
+    tables = []
+    for table_name in list_tables():
+        metadata = read_table_metadata(table_name)
+        if metadata.get("table_type") == "gold" or metadata.get("snapshot") == "true":
+            tables.append(table_name)
+    return tables
+
+
+def write_table(connection, table_name, path):
+    """Stream `table_name` into an Arrow IPC file at `path`; returns its rows."""
+    columns = read_table_metadata(table_name)["columns"]
+    types = [column_type.upper() for column_type in columns.values()]
+    schema = pa.schema([(column, ARROW_TYPES[t]) for column, t in zip(columns, types)])
+    query = f"SELECT {', '.join(columns)} FROM public.{table_name}"
+
+    rows = 0
+    with pa.OSFile(path, "wb") as sink:
+        writer = pa.ipc.new_file(sink, schema)
+        for batch in stream_query(query, connection=connection):
+            arrays = []
+            for i, (field, column_type) in enumerate(zip(schema, types)):
+                convert = CONVERTERS.get(column_type)
+                values = [row[i] for row in batch]
+                if convert:
+                    values = [None if v is None else convert(v) for v in values]
+                arrays.append(pa.array(values, type=field.type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows += len(batch)
+        writer.close()
+    return rows
+
+
+def replace_file(path, content):
+    # Write then rename so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def export_snapshot(table_names=None, folder=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    """Write `table_names` (default `snapshot_tables`) to a new snapshot.
+
+    Every table is read in one REPEATABLE READ transaction, taken once their
+    builds are done (`table_locks`), so a snapshot never mixes two runs of the
+    DAG nor catches a table mid-swap. The snapshot is written under a temporary name
+    and only made the LATEST once complete; all but the `keep` snapshots
+    before it are removed. Returns the snapshot's name.
+    """
+    table_names = table_names or snapshot_tables()
+    os.makedirs(folder, exist_ok=True)
+    start = time.perf_counter()
+    created_at = datetime.now(timezone.utc)
+    name = created_at.strftime("%Y%m%dT%H%M%S%fZ")
+    tmp_folder = tempfile.mkdtemp(dir=folder, prefix=".tmp-")
+    try:
+        manifest = {"created_at": created_at.isoformat(), "tables": {}}
+        # The isolation level is reset when the connection goes back to the pool
+        with table_locks(table_names):
+            connection = checkout().execution_options(isolation_level="REPEATABLE READ")
+            try:
+                with connection.begin():
+                    for table_name in table_names:
+                        path = f"{tmp_folder}/{table_name}.arrow"
+                        rows = write_table(connection, table_name, path)
+                        manifest["tables"][table_name] = rows
+            finally:
+                connection.close()
+        with open(f"{tmp_folder}/manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_folder, f"{folder}/{name}")
+    except Exception:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    replace_file(f"{folder}/LATEST", name)
+
+    snapshots = sorted(
+        entry
+        for entry in os.listdir(folder)
+        if not entry.startswith(".") and os.path.isdir(f"{folder}/{entry}")
+    )
+    for old in snapshots[: -(keep + 1)]:
+        shutil.rmtree(f"{folder}/{old}", ignore_errors=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"Exported {len(table_names)} tables to snapshot {name} in {elapsed:.2f}s.")
+    log_pool_stats()
+    return name
+
+
+class TableQuery:
+    """A SELECT of `columns` from one table, filtered on `where` (a list of
+    (column, operator, value) conditions) and ordered by the first column. It
+    runs on the warehouse (`clause` and `params`) or on a snapshot (`rows`).
+    """
+
+    def __init__(self, table_name, columns, where=()):
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.where = list(where)
+
+    def sql(self, literal=False):
+        """The query, with its values as bind parameters unless `literal`."""
+        sql = f"SELECT {', '.join(self.columns)}\nFROM {self.table_name}"
+        conditions = []
+        for name, (column, op, value) in zip(self.params, self.where):
+            if not literal:
+                value = f":{name}"
+            elif isinstance(value, (int, float)):
+                value = str(value)
+            else:
+                value = "'{}'".format(str(value).replace("'", "''"))
+            conditions.append(f"{column} {op} {value}")
+        if conditions:
+            sql += "\nWHERE " + "\n    AND ".join(conditions)
+        return f"{sql}\nORDER BY 1"
+
+    @property
+    def text(self):
+        return self.sql(literal=True)
+
+    @property
+    def clause(self):
+        return text(self.sql())
+
+    @property
+    def params(self):
+        return {
+            f"{column}_{i}": value for i, (column, _, value) in enumerate(self.where)
+        }
+
+    def rows(self, table):
+        """The query's rows as tuples, from the Arrow `table`.
+
+        The rows are filtered and sorted by Arrow kernels, so only the ones
+        selected become python objects.
+        """
+        mask = None
+        for name, op, value in self.where:
+            column = table.column(name)
+            condition = OPERATORS[op](column, pa.scalar(value, type=column.type))
+            mask = condition if mask is None else pc.and_(mask, condition)
+        if mask is not None:
+            # Rows a condition is NULL for are dropped, as in Postgres
+            table = table.filter(mask)
+        # NULLs sort last, as in Postgres
+        table = table.sort_by([(self.columns[0], "ascending")])
+        return list(zip(*(table.column(name).to_pylist() for name in self.columns)))
+
+
+class SnapshotReader:
+    """Memory-maps the tables of the LATEST snapshot, each once per snapshot."""
+
+    def __init__(self, folder=SNAPSHOT_DIR, ttl=SNAPSHOT_TTL):
+        self.folder = folder
+        self.ttl = ttl
+        self.name = None
+        self.checked_at = float("-inf")
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def latest(self):
+        with self.lock:
+            if time.monotonic() - self.checked_at < self.ttl:
+                return self.name
+        try:
+            with open(f"{self.folder}/LATEST") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"No snapshot in {self.folder}; the DAG's export_snapshot writes one"
+            )
+        with self.lock:
+            if name != self.name:
+                self.name, self.tables = name, {}
+            self.checked_at = time.monotonic()
+        return name
+
+    def table(self, table_name):
+        name = self.latest()
+        with self.lock:
+            if name == self.name and table_name in self.tables:
+                return self.tables[table_name]
+        # Reads of a mapped file are zero-copy; pages load as columns are used
+        source = pa.memory_map(f"{self.folder}/{name}/{table_name}.arrow", "r")
+        table = pa.ipc.open_file(source).read_all()
+        with self.lock:
+            if name == self.name:
+                self.tables[table_name] = table
+        return table
+
+    def query(self, query):
+        return query.rows(self.table(query.table_name))
+
+
+snapshot_reader = SnapshotReader()
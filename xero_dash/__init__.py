@@ -1,22 +1,64 @@
 import dash
+import dash_core_components as dcc
 import dash_html_components as html
 
+from dash.dependencies import Input, Output
+
 from xero_dash.dashboard import (
     analysis_customer_churn,
     analysis_geographic_location,
     analysis_plan_upgrade_and_downgrade,
     intro_words,
+    update_churn_figures,
 )
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# The sections' controls only exist once their callbacks have rendered them
+app = dash.Dash(
+    __name__,
+    external_stylesheets=external_stylesheets,
+    suppress_callback_exceptions=True,
+)
+
+# Each section renders as a placeholder and fills itself in from its own
+# callback once the page loads, so the sections' queries run in parallel and
+# never block startup
+SECTIONS = {
+    "churn-section": analysis_customer_churn,
+    "plan-section": analysis_plan_upgrade_and_downgrade,
+    "geo-section": analysis_geographic_location,
+}
 
 app.layout = html.Div(
     [
+        dcc.Location(id="url"),
         *intro_words(),
-        *analysis_customer_churn(),
-        *analysis_plan_upgrade_and_downgrade(),
-        *analysis_geographic_location(),
+        *[
+            dcc.Loading(html.Div(id=section_id), type="default")
+            for section_id in SECTIONS
+        ],
     ]
 )
+
+
+def register_section(section_id, analysis):
+    @app.callback(Output(section_id, "children"), [Input("url", "pathname")])
+    def load_section(pathname):
+        return analysis()
+
+
+for section_id, analysis in SECTIONS.items():
+    register_section(section_id, analysis)
+
+
+@app.callback(
+    [Output("churn_graph", "figure"), Output("churn-graph2", "figure")],
+    [
+        Input("churn-granularity", "value"),
+        Input("churn-range", "start_date"),
+        Input("churn-range", "end_date"),
+    ],
+)
+def update_churn(granularity, start_date, end_date):
+    return update_churn_figures(granularity, start_date, end_date)
@@ -1,9 +1,133 @@
+import os
+import textwrap
+
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.graph_objects as go
 
-from sqlalchemy import text
-from libraries.database import session_scope
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from dash.exceptions import PreventUpdate
+from libraries.database import read_sql
+from libraries.query_cache import cached_query
+from libraries.snapshots import TableQuery, snapshot_reader
+
+# Independent panel queries run concurrently on this pool
+DASH_QUERY_WORKERS = int(os.getenv("DASH_QUERY_WORKERS", "4"))
+query_pool = ThreadPoolExecutor(max_workers=DASH_QUERY_WORKERS)
+
+# `warehouse` reads Postgres (through the query cache); `snapshot` memory-maps
+# the latest Arrow snapshot the DAG exported, without touching Postgres
+DASH_READ_MODE = os.getenv("DASH_READ_MODE", "warehouse")
+
+# Granularities of churn_rollup, and how the churn graphs title them
+CHURN_GRANULARITIES = {"day": "Daily", "week": "Weekly", "month": "Monthly"}
+
+
+def period_start(date, granularity):
+    """The start of the `granularity` period `date` falls in, as DATE_TRUNC does."""
+    date = datetime(date.year, date.month, date.day)
+    if granularity == "week":
+        return date - timedelta(days=date.weekday())
+    if granularity == "month":
+        return date.replace(day=1)
+    return date
+
+
+def churn_query(granularity="month", start=None, end=None):
+    """The churn_rollup periods of `granularity` overlapping `start` to `end`."""
+    where = [("granularity", "=", granularity)]
+    if start:
+        where.append(("period", ">=", period_start(start, granularity)))
+    if end:
+        where.append(("period", "<=", end))
+    return TableQuery(
+        "churn_rollup", ["period", "churned_accounts", "churn_rate"], where=where
+    )
+
+
+# Every panel reads a small gold table the ETL builds (see etl/sql)
+CHURN_QUERY = churn_query("month")
+
+PLAN_SIGNUPS_QUERY = TableQuery("signup_plan_distribution", ["plan", "signups"])
+
+PLAN_CHANGES_QUERY = TableQuery(
+    "plan_change_summary", ["plan_change", "customers", "avg_days_to_change"]
+)
+
+PROVINCE_QUERY = TableQuery(
+    "province_by_year",
+    ["province", "signups", "active_users"],
+    where=[("year", "=", datetime(2019, 1, 1))],
+)
+
+
+def read_query(query):
+    if DASH_READ_MODE == "snapshot":
+        return snapshot_reader.query(query)
+    return cached_query(query.clause, query.params)
+
+
+def run_queries(*queries):
+    """Run independent queries concurrently and return their rows in order."""
+    futures = [query_pool.submit(read_query, query) for query in queries]
+    return [future.result() for future in futures]
+
+
+def solution(sql):
+    """SQL indented to sit inside the Markdown writeups below."""
+    return textwrap.indent(textwrap.dedent(sql).strip(), " " * 8).lstrip()
+
+
+def model_sql(table_name):
+    """The query the ETL builds `table_name` from, without its header."""
+    lines = read_sql(table_name).splitlines()
+    while lines and (not lines[0].strip() or lines[0].startswith("--")):
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def churn_figures(granularity="month", start=None, end=None):
+    """The churned accounts and churn rate figures of the churn section."""
+    rows = read_query(churn_query(granularity, start, end))
+    title = CHURN_GRANULARITIES[granularity]
+    churned = [row for row in rows if row[1] > 0]
+    count_figure = {
+        "data": [
+            {
+                "x": [row[0] for row in churned],
+                "y": [row[1] for row in churned],
+                "type": "line",
+                "name": "Churned",
+            }
+        ],
+        "layout": {"title": f"{title} Churned Accounts"},
+    }
+    rate_figure = {
+        "data": [
+            {
+                "x": [row[0] for row in rows],
+                "y": [row[2] for row in rows],
+                "type": "line",
+            }
+        ],
+        "layout": {"title": f"{title} Churn Rate"},
+    }
+    return count_figure, rate_figure
+
+
+def update_churn_figures(granularity, start_date, end_date):
+    """Callback of the churn controls; the dates are the picker's ISO strings."""
+    if granularity not in CHURN_GRANULARITIES:
+        raise PreventUpdate
+    try:
+        start = datetime.fromisoformat(start_date) if start_date else None
+        end = datetime.fromisoformat(end_date) if end_date else None
+    except (TypeError, ValueError):
+        raise PreventUpdate
+    if start and end and start > end:
+        raise PreventUpdate
+    return churn_figures(granularity, start, end)
 
 
 def intro_words():
@@ -24,6 +148,8 @@ def intro_words():
 
 def analysis_customer_churn():
 
+    count_figure, rate_figure = churn_figures()
+
     problem = dcc.Markdown(
         """
         ## Customer Churn
@@ -42,21 +168,6 @@ def analysis_customer_churn():
         """
     )
 
-    with session_scope() as transaction:
-        query = text(
-            """
-            SELECT
-                DATE_TRUNC('month', churn_date AT TIME ZONE 'EST') AS month,
-                COUNT(DISTINCT account) AS churned_accounts
-            FROM churn_event
-            GROUP BY 1
-            ORDER BY 1
-            """
-        )
-        results = transaction.execute(query).fetchall()
-        x = [row[0] for row in results]
-        y = [row[1] for row in results]
-
     writeup = dcc.Markdown(
         f"""
         #### Assumptions:
@@ -71,20 +182,38 @@ def analysis_customer_churn():
         * Ignore churn for logins in the most recent 30 days of data (Dec 01 2019)
 
         #### Solution:
+        Built by the ETL into the `churn_rollup` gold table, once per day,
+        week and month, so changing the controls below only reads the few
+        rows of the granularity and date range picked:
         ```sql
-        {query.text}
+        {solution(model_sql("churn_rollup"))}
         ```
         """
     )
 
-    graph = dcc.Graph(
-        id="churn_graph",
-        figure={
-            "data": [{"x": x, "y": y, "type": "line", "name": "Churned"}],
-            "layout": {"title": "Monthly Churned Accounts"},
-        },
+    controls = html.Div(
+        [
+            dcc.Dropdown(
+                id="churn-granularity",
+                options=[
+                    {"label": label, "value": granularity}
+                    for granularity, label in CHURN_GRANULARITIES.items()
+                ],
+                value="month",
+                clearable=False,
+                style={"width": "200px", "display": "inline-block"},
+            ),
+            dcc.DatePickerRange(
+                id="churn-range",
+                display_format="YYYY-MM-DD",
+                clearable=True,
+                style={"display": "inline-block", "margin-left": "20px"},
+            ),
+        ]
     )
 
+    graph = dcc.Graph(id="churn_graph", figure=count_figure)
+
     problem2 = dcc.Markdown(
         """
         ### Monthly Churn Rate
@@ -99,38 +228,6 @@ def analysis_customer_churn():
         """
     )
 
-    with session_scope() as transaction:
-        query = text(
-            """
-            WITH active_accounts AS (
-                SELECT
-                    DATE_TRUNC('month', date AT TIME ZONE 'EST') AS month,
-                    COUNT(DISTINCT account) AS accounts
-                FROM login
-                GROUP BY 1
-            ),
-
-            churned_accounts AS (
-                SELECT
-                    DATE_TRUNC('month', churn_date AT TIME ZONE 'EST') AS month,
-                    COUNT(DISTINCT account) AS churned_accounts
-                FROM churn_event
-                GROUP BY 1
-            )
-
-            SELECT
-                month,
-                1.0 * COALESCE(churned_accounts, 0) / COALESCE(accounts, 0) AS churn_rate
-            FROM active_accounts AS aa
-            FULL JOIN churned_accounts AS ca
-                USING (month)
-            ORDER BY 1
-            """
-        )
-        results = transaction.execute(query).fetchall()
-        x = [row[0] for row in results]
-        y = [row[1] for row in results]
-
     writeup2 = dcc.Markdown(
         f"""
         #### Assumptions:
@@ -138,25 +235,18 @@ def analysis_customer_churn():
         Same assumptions as before.
 
         #### Solution:
-        ```sql
-        {query.text}
-        ```
+        The `churn_rate` column of the same `churn_rollup` gold table.
         """
     )
 
-    graph2 = dcc.Graph(
-        id="churn-graph2",
-        figure={
-            "data": [{"x": x, "y": y, "type": "line"}],
-            "layout": {"title": "Monthly Churn Rate"},
-        },
-    )
+    graph2 = dcc.Graph(id="churn-graph2", figure=rate_figure)
 
     return [
         html.Hr(),
         html.Hr(),
         problem,
         writeup,
+        controls,
         graph,
         html.Hr(),
         problem2,
@@ -167,6 +257,8 @@ def analysis_customer_churn():
 
 def analysis_plan_upgrade_and_downgrade():
 
+    signup_rows, plan_change_rows = run_queries(PLAN_SIGNUPS_QUERY, PLAN_CHANGES_QUERY)
+
     problem = dcc.Markdown(
         """
         ## Plan Upgrade and Downgrade Analysis
@@ -184,16 +276,6 @@ def analysis_plan_upgrade_and_downgrade():
         """
     )
 
-    query = text(
-        """
-        SELECT
-            plan,
-            COUNT(DISTINCT account) AS signups
-        FROM signup
-        GROUP BY 1
-        """
-    )
-
     writeup = dcc.Markdown(
         f"""
         #### Assumptions:
@@ -201,16 +283,15 @@ def analysis_plan_upgrade_and_downgrade():
         * No new assumptions
 
         #### Solution:
+        Built by the ETL into the `signup_plan_distribution` gold table:
         ```sql
-        {query.text}
+        {solution(model_sql("signup_plan_distribution"))}
         ```
         """
     )
 
-    with session_scope() as transaction:
-        results = transaction.execute(query).fetchall()
-        labels = [row[0] for row in results]
-        values = [row[1] for row in results]
+    labels = [row[0] for row in signup_rows]
+    values = [row[1] for row in signup_rows]
 
     fig = go.Figure(data=[go.Pie(labels=labels, values=values)])
     fig.update_layout(title_text="Plan Selections At Signup", title_x=0.5)
@@ -230,22 +311,6 @@ def analysis_plan_upgrade_and_downgrade():
         """
     )
 
-    query = text(
-        """
-        SELECT
-            pc.details_from || ' to ' || pc.details_to AS plan_change,
-            COUNT(DISTINCT pc.account) AS customers,
-            AVG(DATE_PART('day',
-                    (pc.details_change_date - signup.date)
-                )) AS avg_days_to_change
-        FROM plan_change AS pc
-        INNER JOIN signup
-            USING (account)
-        GROUP BY 1
-        ORDER BY 1
-        """
-    )
-
     writeup2 = dcc.Markdown(
         f"""
         #### Assumptions:
@@ -254,15 +319,13 @@ def analysis_plan_upgrade_and_downgrade():
             in the current dataset, but might not hold true future data.
 
         #### Solution:
+        Built by the ETL into the `plan_change_summary` gold table:
         ```sql
-        {query.text}
+        {solution(model_sql("plan_change_summary"))}
         ```
         """
     )
 
-    with session_scope() as transaction:
-        results = transaction.execute(query).fetchall()
-
     fig = go.Figure(
         data=[
             go.Table(
@@ -271,9 +334,9 @@ def analysis_plan_upgrade_and_downgrade():
                 ),
                 cells=dict(
                     values=[
-                        [row[0] for row in results],
-                        [row[1] for row in results],
-                        [row[2] for row in results],
+                        [row[0] for row in plan_change_rows],
+                        [row[1] for row in plan_change_rows],
+                        [row[2] for row in plan_change_rows],
                     ]
                 ),
             )
@@ -296,6 +359,8 @@ def analysis_plan_upgrade_and_downgrade():
 
 
 def analysis_geographic_location():
+    province_rows = read_query(PROVINCE_QUERY)
+
     problem = dcc.Markdown(
         """
         ## Geographic Location Analysis
@@ -309,15 +374,6 @@ def analysis_geographic_location():
         """
     )
 
-    query = text(
-        """
-        SELECT province, signups, active_users
-        FROM province_by_year
-        WHERE year = '2019-01-01'
-        ORDER BY 1
-        """
-    )
-
     writeup = dcc.Markdown(
         f"""
         #### Assumptions:
@@ -334,16 +390,14 @@ def analysis_geographic_location():
 
         #### Solution:
         ```sql
-        {query.text}
+        {solution(PROVINCE_QUERY.text)}
         ```
         """
     )
 
-    with session_scope() as transaction:
-        results = transaction.execute(query).fetchall()
-        provinces = [row[0] for row in results]
-        signups = [row[1] for row in results]
-        actives = [row[2] for row in results]
+    provinces = [row[0] for row in province_rows]
+    signups = [row[1] for row in province_rows]
+    actives = [row[2] for row in province_rows]
 
     graph = dcc.Graph(
         id="geo_graph",